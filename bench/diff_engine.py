@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Compares the preview diff engines of xd on generated files.
+#
+# Usage: bench/diff_engine.py [--lines N] [--repeat N] [--json]
+
+import difflib
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xd
+
+#------------------------------ generators ------------------------------
+
+def sourceLine(r):
+  return '%s%s = %s(%s)\n' % (' ' * r.choice((0, 2, 4, 6)),
+                              r.choice(('x', 'path', 'parsed', 'result')),
+                              r.choice(('open', 'len', 'getattr', 'max')),
+                              r.randint(0, 100000))
+
+def logLine(r):
+  return '%s %s\n' % (r.choice(('INFO', 'WARN', 'DEBUG')),
+                      r.choice(('started', 'stopped', 'retrying', 'ok')))
+
+def mutate(r, lines, edits, make_line):
+  lines = list(lines)
+  for _ in xrange(edits):
+    p = r.randint(0, len(lines))
+    op = r.random()
+    if op < 0.4:
+      lines[p:p] = [make_line(r) for _ in xrange(r.randint(1, 5))]
+    elif op < 0.8:
+      del lines[p:p + r.randint(1, 5)]
+    else:
+      lines[p:p + 1] = [make_line(r)]
+  return lines
+
+def generate(name, n, seed=0):
+  r = random.Random(seed)
+  if name == 'source':
+    lines1 = [sourceLine(r) for _ in xrange(n)]
+    return lines1, mutate(r, lines1, n / 100, sourceLine)
+  if name == 'repetitive':
+    lines1 = [logLine(r) for _ in xrange(n)]
+    return lines1, mutate(r, lines1, n / 100, logLine)
+  if name == 'few-edits':
+    lines1 = [sourceLine(r) for _ in xrange(n * 5)]
+    return lines1, mutate(r, lines1, 10, sourceLine)
+  if name == 'rewrite':
+    return ([sourceLine(r) for _ in xrange(n)],
+            [sourceLine(r) for _ in xrange(n)])
+  raise ValueError(name)
+
+CASES = ('source', 'repetitive', 'few-edits', 'rewrite')
+
+#------------------------------ timing ------------------------------
+
+def timeDifflib(lines1, lines2):
+  return len(list(difflib.unified_diff(lines1, lines2))[2:])
+
+def timeEngine(engine):
+  def run(lines1, lines2):
+    blocks = engine.getMatchingBlocks(lines1, lines2)
+    return len(list(xd.unifiedDiff(lines1, lines2, blocks)))
+  return run
+
+def measure(function, lines1, lines2, repeat):
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    size = function(lines1, lines2)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, size
+
+#------------------------------ main ------------------------------
+
+def main(argv=sys.argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--lines', type='int', default=20000,
+                    help='lines per generated file [%default]')
+  parser.add_option('--repeat', type='int', default=3,
+                    help='runs per measurement, best is kept [%default]')
+  parser.add_option('--json', action='store_true',
+                    help='print results as JSON lines')
+  options, _ = parser.parse_args(argv[1:])
+
+  engines = [('difflib.unified_diff', timeDifflib),
+             ('xd.' + xd.FastEngine.name, timeEngine(xd.FastEngine))]
+  if not options.json:
+    print '%-12s %8s %8s  %-22s %10s %10s' % (
+        'case', 'lines1', 'lines2', 'engine', 'seconds', 'output')
+  for case in CASES:
+    lines1, lines2 = generate(case, options.lines)
+    baseline = None
+    for name, function in engines:
+      elapsed, size = measure(function, lines1, lines2, options.repeat)
+      if baseline is None:
+        baseline = elapsed
+      if options.json:
+        print ('{"case": "%s", "lines1": %d, "lines2": %d, "engine": "%s", '
+               '"seconds": %.6f, "output_lines": %d}' % (
+                   case, len(lines1), len(lines2), name, elapsed, size))
+      else:
+        print '%-12s %8d %8d  %-22s %10.4f %10d  x%.1f' % (
+            case, len(lines1), len(lines2), name, elapsed, size,
+            baseline / max(elapsed, 1e-9))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+# Times the stages of an xd run on generated git and svn repositories:
+# interpreter startup, one external diff child (run as a script and through
+# the child wrapper), collection per engine, headless previews per diff
+# engine and an incremental rerun.
+#
+# Usage: bench/end_to_end.py [--scm git,svn] [--files N] [--size BYTES]
+#                            [--binary-ratio R] [--churn R] [--json]
+
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+XD = os.path.join(ROOT, 'xd.py')
+
+sys.path.insert(0, ROOT)
+
+import xd
+
+#------------------------------ repositories ------------------------------
+
+def run(args, cwd=None):
+  p = subprocess.Popen(args, cwd=cwd, stdin=open(os.devnull),
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                       close_fds=True)
+  output = p.communicate()[0]
+  if p.returncode != 0:
+    raise RuntimeError('%s failed:\n%s' % (' '.join(args), output))
+  return output
+
+def hasCommand(name):
+  for dirname in os.environ.get('PATH', '').split(os.pathsep):
+    if os.access(os.path.join(dirname, name), os.X_OK):
+      return True
+  return False
+
+def textContent(r, size):
+  lines = []
+  total = 0
+  while total < size:
+    line = 'line %d: %s\n' % (r.randint(0, 1 << 30),
+                              ' '.join(r.choice(('xd', 'diff', 'path', 'rev',
+                                                 'hash', 'file', 'tool'))
+                                       for _ in xrange(r.randint(1, 8))))
+    lines.append(line)
+    total += len(line)
+  return ''.join(lines)
+
+def binaryContent(r, size):
+  return ''.join(chr(r.getrandbits(8)) for _ in xrange(size))
+
+def churnContent(r, data):
+  lines = data.splitlines(True)
+  for _ in xrange(max(1, len(lines) / 20)):
+    p = r.randint(0, len(lines))
+    lines[p:p + r.randint(0, 2)] = ['changed %d\n' % r.randint(0, 1 << 30)]
+  return ''.join(lines)
+
+def writeTree(r, path, options):
+  names = []
+  for i in xrange(options.files):
+    name = os.path.join('d%d' % (i % 16), 'f%d' % i)
+    size = max(1, int(r.expovariate(1.0 / options.size)))
+    if r.random() < options.binary_ratio:
+      data = binaryContent(r, size)
+    else:
+      data = textContent(r, size)
+    if not os.path.isdir(os.path.join(path, os.path.dirname(name))):
+      os.makedirs(os.path.join(path, os.path.dirname(name)))
+    open(os.path.join(path, name), 'wb').write(data)
+    names.append(name)
+  return names
+
+def churnTree(r, path, names, ratio):
+  changed = r.sample(names, int(len(names) * ratio))
+  for name in changed:
+    filename = os.path.join(path, name)
+    data = open(filename, 'rb').read()
+    if '\0' in data:
+      data = data[:len(data) / 2] + binaryContent(r, 64)
+    else:
+      data = churnContent(r, data)
+    open(filename, 'wb').write(data)
+  return changed
+
+def makeGit(base, r, options):
+  wc = os.path.join(base, 'git')
+  os.mkdir(wc)
+  run(['git', 'init', '-q', '.'], wc)
+  names = writeTree(r, wc, options)
+  run(['git', 'add', '.'], wc)
+  run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+       'commit', '-q', '-m', 'base'], wc)
+  return wc, names
+
+def makeSvn(base, r, options):
+  repo = os.path.join(base, 'svnrepo')
+  wc = os.path.join(base, 'svn')
+  run(['svnadmin', 'create', repo])
+  run(['svn', 'checkout', '-q', 'file://' + repo, wc])
+  names = writeTree(r, wc, options)
+  run(['svn', 'add', '-q'] + sorted(set(os.path.dirname(n) for n in names)),
+      wc)
+  run(['svn', 'commit', '-q', '-m', 'base'], wc)
+  return wc, names
+
+#------------------------------ stages ------------------------------
+
+def timeStartup(repeat):
+  env = dict(os.environ)
+  env[xd.XD_DIR_ENV] = os.path.join(tempfile.gettempdir(), 'xd.none.0')
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    subprocess.call([sys.executable, XD], env=env,
+                    stderr=open(os.devnull, 'w'))
+    elapsed = time.time() - start
+    best = best is None and elapsed or min(best, elapsed)
+  return best
+
+def newXdDir(scm, name):
+  xd_dir = os.path.join(scm.getTmpDir(), 'xd.%s.bench%d%s' % (
+      scm.__name__.lower(), os.getpid(), name))
+  if os.path.isdir(xd_dir):
+    shutil.rmtree(xd_dir)
+  os.mkdir(xd_dir)
+  return xd_dir
+
+def timeExternalDiff(scm, wc, names, count, wrapper):
+  xd_dir = newXdDir(scm, 'child')
+  env = dict(os.environ)
+  env[xd.XD_DIR_ENV] = xd_dir
+  if wrapper:
+    command = [xd.setupChildCommand(xd_dir, XD)]
+  else:
+    command = [sys.executable, XD]
+  start = time.time()
+  for name in names[:count]:
+    path = os.path.join(wc, name)
+    if scm is xd.Git:
+      argv = [name, path, '0' * 40, '100644', path, '0' * 40, '100644']
+    else:
+      argv = ['-u', '-L', '%s\t(revision 1)' % name, '-L',
+              '%s\t(working copy)' % name, path, path]
+    subprocess.call(command + argv, env=env, cwd=wc)
+  elapsed = time.time() - start
+  shutil.rmtree(xd_dir)
+  return elapsed / max(1, min(count, len(names)))
+
+def collect(scm, xd_dir, previous=None):
+  env = dict(os.environ)
+  env[xd.XD_DIR_ENV] = xd_dir
+  cmdline = scm.setupCmdLine([XD])
+  start = time.time()
+  job = xd.ScmDiffJob(scm, cmdline, env, xd_dir, XD, previous)
+  returncode = job.wait()
+  elapsed = time.time() - start
+  if returncode != 0:
+    raise RuntimeError('collection exited with %s' % returncode)
+  pairs = list(job.manifest.read())
+  job.kill()
+  return elapsed, pairs
+
+def timePreviews(pairs, engine, count):
+  times = []
+  for parsed in pairs[:count]:
+    start = time.time()
+    xd.diffFiles(parsed['xd_dir_path1'], parsed['xd_dir_path2'], None, engine)
+    times.append(time.time() - start)
+  times.sort()
+  return times
+
+#------------------------------ main ------------------------------
+
+def main(argv=sys.argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--scm', default='git,svn',
+                    help='comma separated SCMs to benchmark [%default]')
+  parser.add_option('--files', type='int', default=500,
+                    help='files in the generated repository [%default]')
+  parser.add_option('--size', type='int', default=8192,
+                    help='mean file size in bytes [%default]')
+  parser.add_option('--binary-ratio', type='float', default=0.05,
+                    help='fraction of binary files [%default]')
+  parser.add_option('--churn', type='float', default=0.2,
+                    help='fraction of files changed in the diff [%default]')
+  parser.add_option('--children', type='int', default=20,
+                    help='external diff children to time [%default]')
+  parser.add_option('--previews', type='int', default=50,
+                    help='previews to time per diff engine [%default]')
+  parser.add_option('--repeat', type='int', default=3,
+                    help='runs per startup measurement, best is kept '
+                         '[%default]')
+  parser.add_option('--seed', type='int', default=0,
+                    help='random seed for the generated trees [%default]')
+  parser.add_option('--json', action='store_true',
+                    help='print results as JSON lines')
+  parser.add_option('--keep', action='store_true',
+                    help='keep the generated repositories')
+  options, _ = parser.parse_args(argv[1:])
+
+  def report(scm, stage, variant, seconds, count=None):
+    if options.json:
+      print ('{"scm": "%s", "stage": "%s", "variant": "%s", "seconds": %.6f, '
+             '"count": %s}' % (scm, stage, variant, seconds,
+                               count is None and 'null' or count))
+    else:
+      print '%-5s %-14s %-10s %10.4f %8s' % (scm, stage, variant, seconds,
+                                              count is None and '-' or count)
+    sys.stdout.flush()
+
+  if not options.json:
+    print '%-5s %-14s %-10s %10s %8s' % ('scm', 'stage', 'variant', 'seconds',
+                                         'count')
+  report('-', 'startup', 'python', timeStartup(options.repeat))
+
+  base = tempfile.mkdtemp(prefix='xd-bench.')
+  cwd = os.getcwd()
+  try:
+    for name in options.scm.split(','):
+      scm = xd.ScmMeta.getByName(name)
+      if scm is None or not hasCommand(name) or (
+          name == 'svn' and not hasCommand('svnadmin')):
+        if not options.json:
+          print '%-5s skipped, %s is not available' % (name, name)
+        continue
+      r = random.Random(options.seed)
+      wc, names = (name == 'git' and makeGit or makeSvn)(base, r, options)
+      changed = churnTree(r, wc, names, options.churn)
+      os.chdir(wc)
+
+      for variant, wrapper in (('script', False), ('wrapper', True)):
+        report(name, 'external-diff', variant,
+               timeExternalDiff(scm, wc, changed, options.children, wrapper), 1)
+
+      pairs = None
+      xd_dirs = []
+      engines = hasattr(scm, 'collect') and ('collect', 'extdiff') or (
+          'extdiff',)
+      for engine in engines:
+        os.environ[xd.XD_ENGINE_ENV] = engine
+        xd_dirs.append(newXdDir(scm, engine))
+        elapsed, collected = collect(scm, xd_dirs[-1])
+        report(name, 'collect', engine, elapsed, len(collected))
+        if pairs is None:
+          pairs = collected
+      os.environ.pop(xd.XD_ENGINE_ENV, None)
+
+      for engine in xd.DIFF_ENGINES:
+        times = timePreviews(pairs, engine, options.previews)
+        if times:
+          report(name, 'preview-mean', engine.name, sum(times) / len(times),
+                 len(times))
+          report(name, 'preview-max', engine.name, times[-1], len(times))
+
+      # Rerun after touching a tenth of the changed files again, once from
+      # scratch and once reusing the pairs of the previous collection.
+      churnTree(r, wc, changed, 0.1)
+      xd_dirs.append(newXdDir(scm, 'rerun'))
+      elapsed, collected = collect(scm, xd_dirs[-1])
+      report(name, 'rerun', 'full', elapsed, len(collected))
+      previous = dict((scm.getPairId(parsed), parsed) for parsed in collected)
+      previous.pop(None, None)
+      churnTree(r, wc, changed, 0.1)
+      for filename in ('FILES', 'STDOUT'):
+        if os.path.exists(os.path.join(xd_dirs[-1], filename)):
+          os.remove(os.path.join(xd_dirs[-1], filename))
+      elapsed, collected = collect(scm, xd_dirs[-1], previous)
+      report(name, 'rerun', 'reuse', elapsed, len(collected))
+      for xd_dir in xd_dirs:
+        shutil.rmtree(xd_dir)
+      os.chdir(cwd)
+  finally:
+    os.chdir(cwd)
+    if options.keep:
+      print >>sys.stderr, 'repositories kept in %s' % base
+    else:
+      shutil.rmtree(base)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Drives the real window through mainController on a generated git
+# repository.  Needs Tkinter and a display, and is skipped without them.
+#
+# Usage: python -m unittest discover tests
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+import xd
+
+def run(args, cwd=None):
+  p = subprocess.Popen(args, cwd=cwd, stdin=open(os.devnull),
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                       close_fds=True)
+  output = p.communicate()[0]
+  if p.returncode != 0:
+    raise RuntimeError('%s failed:\n%s' % (' '.join(args), output))
+  return output
+
+def findCommand(name):
+  for dirname in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(dirname, name)
+    if os.access(path, os.X_OK):
+      return path
+  return None
+
+def hasDisplay():
+  try:
+    import Tkinter
+    Tkinter.Tk().destroy()
+  except Exception:
+    return False
+  return True
+
+
+@unittest.skipUnless(findCommand('git') and hasDisplay(),
+                     'needs git, Tkinter and a display')
+class StreamingTest(unittest.TestCase):
+
+  # The window opens after half a second even when no pair has arrived yet,
+  # so the SCM is slowed down by a wrapper that sleeps before 'git diff'.
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.path = os.environ['PATH']
+    self.tmp_dir = tempfile.mkdtemp()
+    repo = os.path.join(self.tmp_dir, 'repo')
+    run(['git', 'init', '-q', repo])
+    run(['git', 'config', 'user.name', 'xd'], repo)
+    run(['git', 'config', 'user.email', 'xd@localhost'], repo)
+    open(os.path.join(repo, 'f.txt'), 'w').write('a\nb\n')
+    run(['git', 'add', 'f.txt'], repo)
+    run(['git', 'commit', '-q', '-m', 'f'], repo)
+    open(os.path.join(repo, 'f.txt'), 'w').write('a\nc\n')
+    bin_dir = os.path.join(self.tmp_dir, 'bin')
+    os.mkdir(bin_dir)
+    wrapper = os.path.join(bin_dir, 'git')
+    f = open(wrapper, 'w')
+    print >>f, '#!/bin/sh'
+    print >>f, 'case "$1" in diff) sleep 1 ;; esac'
+    print >>f, 'exec %s "$@"' % xd.escapeShell(findCommand('git'))
+    f.close()
+    os.chmod(wrapper, 0755)
+    os.environ['PATH'] = bin_dir + os.pathsep + self.path
+    os.chdir(repo)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    os.environ['PATH'] = self.path
+    shutil.rmtree(self.tmp_dir)
+
+  def testOpenWithEmptyRunningJob(self):
+    import Tkinter
+    seen = {}
+    mainloop = Tkinter.Tk.mainloop
+
+    def poll(app, deadline):
+      if ((app.job.poll() is None or app.load_files_id is not None) and
+          time.time() < deadline):
+        app.after(50, poll, app, deadline)
+        return
+      seen['loaded'] = app.file_listbox_labelframe.cget('text')
+      app.destroy()
+
+    def checkedMainloop(app, *args):
+      seen['running'] = app.job.poll() is None
+      seen['opened'] = app.file_listbox_labelframe.cget('text')
+      app.after(50, poll, app, time.time() + 10)
+      mainloop(app, *args)
+
+    Tkinter.Tk.mainloop = checkedMainloop
+    try:
+      returncode = xd.mainController(['xd'])
+    finally:
+      Tkinter.Tk.mainloop = mainloop
+    self.assertFalse(returncode)
+    self.assertTrue(seen['running'])
+    self.assertTrue(seen['opened'].startswith('0 pairs of files'))
+    self.assertTrue(seen['loaded'].startswith('1 pair of files'),
+                    seen['loaded'])
+
+
+if __name__ == '__main__':
+  unittest.main()
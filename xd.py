@@ -4,10 +4,8 @@
 
 import cPickle
 import os
-import shutil
-import string
-import subprocess
 import sys
+import thread
 
 #------------------------------ constants ------------------------------
 
@@ -15,6 +13,26 @@ XD_DIR_ENV = 'XD_DIR'
 
 XD_DIFF_ENV = 'XD_DIFF'
 
+XD_ENGINE_ENV = 'XD_ENGINE'
+
+XD_PREVIEW_CACHE_ENV = 'XD_PREVIEW_CACHE'
+
+XD_PREFETCH_ENV = 'XD_PREFETCH'
+
+XD_DIFF_ENGINE_ENV = 'XD_DIFF_ENGINE'
+
+XD_BLOB_STORE_ENV = 'XD_BLOB_STORE'
+
+XD_BLOB_STORE_SIZE_ENV = 'XD_BLOB_STORE_SIZE'
+
+XD_SVN_JOBS_ENV = 'XD_SVN_JOBS'
+
+XD_TRACE_ENV = 'XD_TRACE'
+
+XD_LAZY_ENV = 'XD_LAZY'
+
+XD_MAX_TOOLS_ENV = 'XD_MAX_TOOLS'
+
 #------------------------------ utilities ------------------------------
 
 def importStar(name, **additional):
@@ -72,6 +90,13 @@ def escapeShell(s):
   else:
     return "'%s'" % s
 
+def escapeVim(s):
+  # Escapes a file name for an ex command as Vim's fnameescape() does.
+  s = ''.join(c in ' \t\n*?[{`$\\%#\'"|!<' and '\\' + c or c for c in s)
+  if s[:1] in ('+', '>') or s == '-':
+    s = '\\' + s
+  return s
+
 def abbrPath(path):
 
   def check(real, short):
@@ -92,6 +117,7 @@ def abbrPath(path):
   return shortest[0]
 
 def isText(lines):
+  import string
   total = 0
   binary = 0
   for line in lines:
@@ -101,6 +127,490 @@ def isText(lines):
       return False
   return total == 0 or binary * 100 < total
 
+#------------------------------ trace ------------------------------
+
+# With XD_TRACE set, every process and thread appends complete events in the
+# Chrome trace event format to that file, one O_APPEND write each.  The
+# controller starts the JSON array; the closing bracket is optional there.
+
+trace_fd = None
+
+def traceInit():
+  path = os.environ.get(XD_TRACE_ENV)
+  if path and (not os.path.exists(path) or os.path.getsize(path) == 0):
+    print >>open(path, 'a'), '['
+
+def traceStart():
+  if os.environ.get(XD_TRACE_ENV):
+    import time
+    return time.time()
+  return None
+
+def traceSpan(name, start, **args):
+  if start is None:
+    return
+  import time
+  end = time.time()
+  event = {'name': name, 'cat': 'xd', 'ph': 'X', 'pid': os.getpid(),
+           'tid': thread.get_ident(), 'ts': int(start * 1000000),
+           'dur': int((end - start) * 1000000)}
+  if args:
+    event['args'] = args
+  traceWrite(event)
+
+def traceCounter(name, values):
+  if not os.environ.get(XD_TRACE_ENV):
+    return
+  import time
+  traceWrite({'name': name, 'cat': 'xd', 'ph': 'C', 'pid': os.getpid(),
+              'ts': int(time.time() * 1000000), 'args': values})
+
+def traceWrite(event):
+  global trace_fd
+  import json
+  if trace_fd is None:
+    trace_fd = os.open(os.environ[XD_TRACE_ENV],
+                       os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+  try:
+    data = json.dumps(event)
+  except UnicodeDecodeError:
+    data = json.dumps(event, encoding='latin-1')
+  os.write(trace_fd, data + ',\n')
+
+#------------------------------ pair ------------------------------
+
+class Pair(object):
+
+  # One pair of files, as parsed from an external diff invocation or collected
+  # by an engine.  Changesets can have tens of thousands of them, so fields
+  # live in slots rather than a dict.  Access stays dict-like, by the same
+  # names, but goes straight to the slots: fields never set raise
+  # AttributeError.
+
+  __slots__ = ('path', 'path1', 'path2', 'flags', 'label1', 'label2',
+               'local_path1', 'local_path2', 'xd_dir_path1', 'xd_dir_path2',
+               'hash1', 'hash2', 'mode1', 'mode2', 'revision1', 'revision2',
+               'rev1', 'rev2', 'url', 'peg', 'status', 'lazy1', 'lazy2')
+
+  def __init__(self, **fields):
+    for key, value in fields.iteritems():
+      setattr(self, key, value)
+
+  __getitem__ = object.__getattribute__
+  __setitem__ = object.__setattr__
+
+  def __contains__(self, key):
+    return key in self.__slots__ and hasattr(self, key)
+
+  def get(self, key, default=None):
+    if key in self.__slots__:
+      return getattr(self, key, default)
+    return default
+
+  def items(self):
+    items = []
+    for key in self.__slots__:
+      value = getattr(self, key, self)
+      if value is not self:
+        items.append((key, value))
+    return items
+
+  def __getstate__(self):
+    return dict(self.items())
+
+  def __setstate__(self, state):
+    self.__init__(**state)
+
+  def getSubstitutions(self):
+    # Returns the mapping for diff tool command lines: every field plus $f1
+    # and $f2, the files to open (working copy files where xd_dir only has a
+    # symlink to them), $v1 and $v2, the same files escaped for a Vim ex
+    # command first, and $l1 and $l2, their labels, all shell escaped.
+    mapping = dict(self.items())
+    for i in (1, 2):
+      path = self['xd_dir_path%s' % i]
+      if os.path.islink(path):
+        path = os.readlink(path)
+      mapping['f%s' % i] = escapeShell(path)
+      mapping['v%s' % i] = escapeShell(escapeVim(path))
+      mapping['l%s' % i] = escapeShell(self['label%s' % i])
+    return mapping
+
+#------------------------------ manifest ------------------------------
+
+MANIFEST_CHUNK = 256
+
+class Manifest(object):
+
+  # FILES holds one record per pair: the length of the pickled fields of a
+  # Pair on a line of its own followed by the pickle.  Records are appended
+  # with a single O_APPEND write, so children never read or rewrite each
+  # other's records; engines in the controller append them in batches.
+
+  def __init__(self, xd_dir):
+    self.path = os.path.join(xd_dir, 'FILES')
+    self.count_path = os.path.join(xd_dir, 'COUNT')
+    self.offset = 0
+
+  def exists(self):
+    return os.path.isfile(self.path)
+
+  def reserveIndex(self, count=1):
+    # Returns the first of count consecutive indexes for prefixes.
+    import fcntl
+    fd = os.open(self.count_path, os.O_RDWR | os.O_CREAT, 0666)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      index = int(os.read(fd, 32) or 0) + 1
+      os.lseek(fd, 0, 0)
+      os.write(fd, '%d\n' % (index + count - 1))
+      return index
+    finally:
+      os.close(fd)
+
+  def append(self, parsed):
+    self.extend([parsed])
+
+  def extend(self, pairs):
+    records = []
+    for parsed in pairs:
+      data = cPickle.dumps(parsed.__getstate__(), cPickle.HIGHEST_PROTOCOL)
+      records.append('%d\n%s' % (len(data), data))
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    try:
+      os.write(fd, ''.join(records))
+    finally:
+      os.close(fd)
+
+  def read(self):
+    if not self.exists():
+      return
+    f = open(self.path, 'rb')
+    f.seek(self.offset)
+    while True:
+      header = f.readline()
+      if not header.endswith('\n'):
+        break
+      size = int(header)
+      data = f.read(size)
+      if len(data) < size:
+        break
+      self.offset = f.tell()
+      yield Pair(**cPickle.loads(data))
+    f.close()
+
+
+class Collector(object):
+
+  # Receives pairs from external diff children over the Unix socket SOCKET in
+  # xd_dir and keeps them in memory.  A child sends its cwd and argv joined by
+  # NULs and waits for the reply, which comes once the controller has parsed
+  # and saved the pair, so the SCM cannot remove its temporary files first.
+  # Pairs from engines running in the controller are appended here directly;
+  # those from children that could not connect still come through FILES.
+
+  def __init__(self, scm, xd_dir):
+    import socket
+    import threading
+    self.scm = scm
+    self.xd_dir = xd_dir
+    self.manifest = Manifest(xd_dir)
+    self.pairs = []
+    self.offset = 0
+    self.lock = threading.Lock()
+    self.closed = False
+    self.path = os.path.join(xd_dir, 'SOCKET')
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self.socket.bind(self.path)
+      self.socket.listen(64)
+      self.socket.settimeout(0.2)
+    except socket.error:
+      self.socket.close()
+      self.socket = None
+      return
+    self.thread = threading.Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def exists(self):
+    return bool(self.pairs) or self.manifest.exists()
+
+  def reserveIndex(self, count=1):
+    return self.manifest.reserveIndex(count)
+
+  def append(self, parsed):
+    self.extend([parsed])
+
+  def extend(self, pairs):
+    self.lock.acquire()
+    try:
+      self.pairs.extend(pairs)
+    finally:
+      self.lock.release()
+
+  def read(self):
+    while self.offset < len(self.pairs):
+      self.offset += 1
+      yield self.pairs[self.offset - 1]
+    for parsed in self.manifest.read():
+      yield parsed
+
+  def run(self):
+    import socket
+    while not self.closed:
+      try:
+        connection = self.socket.accept()[0]
+      except socket.timeout:
+        continue
+      except socket.error:
+        break
+      try:
+        connection.settimeout(60)
+        self.handle(connection)
+      except socket.error:
+        pass
+      connection.close()
+
+  def handle(self, connection):
+    start = traceStart()
+    chunks = []
+    while True:
+      data = connection.recv(65536)
+      if not data:
+        break
+      chunks.append(data)
+    fields = ''.join(chunks).split('\0')
+    cwd, argv = fields[0], fields[1:]
+    path = argv[-1:]
+    try:
+      print >>open(os.path.join(self.xd_dir, 'ARGS'), 'a'), argv
+      parsed = self.scm.parseArgs(argv)
+      path = parsed.get('path', path)
+      for i in (1, 2):
+        parsed['local_path%s' % i] = os.path.join(
+            cwd, parsed['local_path%s' % i])
+      prefix = 'p%s' % self.reserveIndex()
+      self.scm.save(parsed, self.xd_dir, prefix)
+      self.append(parsed)
+      reply = 'ok'
+    except Exception, e:
+      reply = 'error: %s' % e
+    connection.sendall(reply)
+    traceSpan('collect child', start, path=path)
+
+  def close(self):
+    self.closed = True
+    if self.socket is not None:
+      self.thread.join()
+      self.socket.close()
+      self.socket = None
+      if os.path.exists(self.path):
+        os.remove(self.path)
+
+#------------------------------ materialize ------------------------------
+
+FICLONE = 0x40049409
+
+class Materializer(object):
+
+  # Puts a file at a new path as cheaply as the filesystems allow: a hard
+  # link, a reflink (FICLONE), an in-kernel copy with copy_file_range or
+  # sendfile, or a copy through userspace, first that works.  counts tells how
+  # many files and bytes went each way; XD_TRACE records it as a counter.
+
+  counts = {}
+
+  functions = {}
+
+  @classmethod
+  def getFunction(cls, name):
+    # Returns copy_file_range or sendfile from the C library, or None.
+    import ctypes
+    if name not in cls.functions:
+      try:
+        function = getattr(ctypes.CDLL(None, use_errno=True), name)
+      except (AttributeError, OSError):
+        function = None
+      if function is not None:
+        if name == 'copy_file_range':
+          function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        else:
+          function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                               ctypes.c_size_t]
+        function.restype = ctypes.c_ssize_t
+      cls.functions[name] = function
+    return cls.functions[name]
+
+  @classmethod
+  def copyInKernel(cls, name, fd_in, fd_out, size):
+    function = cls.getFunction(name)
+    if not function:
+      return False
+    copied = 0
+    while copied < size:
+      count = min(size - copied, 1 << 30)
+      if name == 'copy_file_range':
+        result = function(fd_in, None, fd_out, None, count, 0)
+      else:
+        result = function(fd_out, fd_in, None, count)
+      if result < 0 or result == 0 and copied == 0:
+        return False
+      if result == 0:
+        break
+      copied += result
+    return True
+
+  @classmethod
+  def copy(cls, src, dst):
+    # Returns the way src was copied to dst.
+    import fcntl
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+      st = os.fstat(fd_in)
+      fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                       st.st_mode & 0777)
+      try:
+        try:
+          fcntl.ioctl(fd_out, FICLONE, fd_in)
+          return 'reflink'
+        except (IOError, OSError):
+          pass
+        for name in ('copy_file_range', 'sendfile'):
+          if cls.copyInKernel(name, fd_in, fd_out, st.st_size):
+            return name
+          os.lseek(fd_in, 0, 0)
+          os.lseek(fd_out, 0, 0)
+          os.ftruncate(fd_out, 0)
+        while True:
+          data = os.read(fd_in, 1024 * 1024)
+          if not data:
+            break
+          while data:
+            data = data[os.write(fd_out, data):]
+        return 'copy'
+      finally:
+        os.close(fd_out)
+    finally:
+      os.close(fd_in)
+
+  @classmethod
+  def materialize(cls, src, dst):
+    start = traceStart()
+    try:
+      os.link(src, dst)
+      via = 'link'
+    except OSError:
+      via = cls.copy(src, dst)
+    size = os.lstat(dst).st_size
+    count = cls.counts.setdefault(via, [0, 0])
+    count[0] += 1
+    count[1] += size
+    traceSpan('materialize', start, via=via, size=size)
+    traceCounter('materialized', dict((name, count[0])
+                                      for name, count in cls.counts.items()))
+    return via
+
+#------------------------------ blob store ------------------------------
+
+class BlobStore(object):
+
+  # Keeps materialized files across sessions under the sha1 of their key (a
+  # git object hash or an svn URL@rev, URL@peg:rev for working copy paths).
+  # Files enter the store by rename and are read-only from then on, so
+  # sessions can hard link them concurrently; evict() drops the least
+  # recently used ones under an exclusive flock.
+
+  def __init__(self, path, max_size):
+    self.path = path
+    self.max_size = max_size
+
+  @classmethod
+  def open(cls):
+    path = os.environ.get(XD_BLOB_STORE_ENV)
+    if not path:
+      return None
+    if not os.path.isdir(path):
+      try:
+        os.makedirs(path)
+      except OSError:
+        return None
+    if not isWritableDir(path):
+      return None
+    return cls(path,
+               int(os.environ.get(XD_BLOB_STORE_SIZE_ENV, 1024)) * 1024 * 1024)
+
+  def getPath(self, key):
+    import hashlib
+    digest = hashlib.sha1(key).hexdigest()
+    return os.path.join(self.path, digest[:2], digest[2:])
+
+  def link(self, key, path):
+    blob_path = self.getPath(key)
+    try:
+      Materializer.materialize(blob_path, path)
+    except (IOError, OSError):
+      if os.path.lexists(path):
+        os.remove(path)
+      return False
+    try:
+      os.utime(blob_path, None)
+    except OSError:
+      pass
+    return True
+
+  def put(self, key, path):
+    # Lazy fetches in several threads may put the same blob at once, so the
+    # temporary file is per thread as well as per process.
+    blob_path = self.getPath(key)
+    if os.path.exists(blob_path):
+      return
+    if not os.path.isdir(os.path.dirname(blob_path)):
+      try:
+        os.mkdir(os.path.dirname(blob_path))
+      except OSError:
+        pass
+    tmp_path = '%s.%d.%d.tmp' % (blob_path, os.getpid(), thread.get_ident())
+    try:
+      Materializer.materialize(path, tmp_path)
+      os.chmod(tmp_path, 0444)
+      os.rename(tmp_path, blob_path)
+    except (IOError, OSError):
+      if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+  def evict(self):
+    import fcntl
+    fd = os.open(os.path.join(self.path, 'LOCK'), os.O_RDWR | os.O_CREAT,
+                 0666)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      blobs = []
+      total = 0
+      for dirpath, _, filenames in os.walk(self.path):
+        if dirpath == self.path:
+          continue
+        for filename in filenames:
+          blob_path = os.path.join(dirpath, filename)
+          try:
+            st = os.stat(blob_path)
+          except OSError:
+            continue
+          blobs.append((st.st_mtime, st.st_size, blob_path))
+          total += st.st_size
+      blobs.sort()
+      for _, size, blob_path in blobs:
+        if total <= self.max_size:
+          break
+        try:
+          os.remove(blob_path)
+          total -= size
+        except OSError:
+          pass
+    finally:
+      os.close(fd)
+
 #------------------------------ scm ------------------------------
 
 class ScmMeta(type):
@@ -158,24 +668,64 @@ class Scm(object):
     cmdline.extend(argv[1:])
     return cmdline
 
+  @staticmethod
+  def getContentId(parsed, i):
+    path = parsed['xd_dir_path%s' % i]
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return (os.path.realpath(path), st.st_size, st.st_mtime)
+
+  @staticmethod
+  def getPairId(parsed):
+    return None
+
+  @staticmethod
+  def getBlobKey(parsed, i):
+    return None
+
+  @staticmethod
+  def isLazy(parsed, i):
+    return False
+
+  @classmethod
+  def fetchLazy(cls, parsed):
+    # Puts the sides left out by save() in place; returns whether any was.
+    fetched = False
+    for i in (1, 2):
+      if (parsed.get('lazy%s' % i) and
+          not os.path.exists(parsed['xd_dir_path%s' % i])):
+        cls.fetch(parsed, i)
+        fetched = True
+    return fetched
+
+  @classmethod
+  def getXdDirPath(cls, parsed, i, xd_dir, prefix=''):
+    xd_dir_path = cls.getUniqueName(parsed, i).replace('/', '_')
+    return os.path.join(xd_dir, '%sf%s__%s' % (prefix, i, xd_dir_path))
+
   @classmethod
   def save(cls, parsed, xd_dir, prefix=''):
+    start = traceStart()
     for i in (1, 2):
       local_path = parsed['local_path%d' % i]
-      xd_dir_path = cls.getUniqueName(parsed, i).replace('/', '_')
-      xd_dir_path = os.path.join(
-          xd_dir, '%sf%s__%s' % (prefix, i, xd_dir_path))
+      xd_dir_path = cls.getXdDirPath(parsed, i, xd_dir, prefix)
       parsed['xd_dir_path%d' % i] = xd_dir_path
-      if cls.isTmpFile(local_path):
-        if os.stat(local_path).st_dev == os.stat(xd_dir).st_dev:
-          os.link(local_path, xd_dir_path)
-        else:
-          shutil.copy(local_path, xd_dir_path)
-        parsed['f%s' % i] = escapeShell(xd_dir_path)
+      if cls.isLazy(parsed, i):
+        parsed['lazy%s' % i] = True
+      elif local_path == xd_dir_path:
+        pass
+      elif cls.isTmpFile(local_path):
+        store = BlobStore.open()
+        key = store and cls.getBlobKey(parsed, i)
+        if not key or not store.link(key, xd_dir_path):
+          Materializer.materialize(local_path, xd_dir_path)
+          if key:
+            store.put(key, xd_dir_path)
       else:
         os.symlink(os.path.abspath(local_path), xd_dir_path)
-        parsed['f%s' % i] = escapeShell(os.path.abspath(local_path))
-      parsed['l%s' % i] = escapeShell(parsed['label%s' % i])
+    traceSpan('save', start, prefix=prefix, path=parsed['path'])
 
 #------------------------------ scm svn ------------------------------
 
@@ -187,7 +737,7 @@ class Svn(Scm):
 
   @staticmethod
   def parseArgs(argv=sys.argv):
-    parsed = {}
+    parsed = Pair()
     parsed['local_path1'], parsed['local_path2'] = argv[-2:]
     parsed['label1'], parsed['label2'] = argv[-5], argv[-3]
     parsed['flags'] = argv[1:-6]
@@ -198,17 +748,23 @@ class Svn(Scm):
     else:
       parsed['path'] = '%s (VS) %s' % (parsed['path1'], parsed['path2'])
     for i in (1, 2):
-      rev = parsed['revision%s' % i]
-      if rev.startswith('(') and rev.endswith(')'):
-        rev = rev[1:-1]
-      if rev.startswith('revision '):
-        rev = rev[9:]
-      parsed['rev%s' % i] = rev
+      parsed['rev%s' % i] = Svn.parseRevision(parsed['revision%s' % i])
     return parsed
 
+  @staticmethod
+  def parseRevision(revision):
+    rev = revision
+    if rev.startswith('(') and rev.endswith(')'):
+      rev = rev[1:-1]
+    if rev.startswith('revision '):
+      rev = rev[9:]
+    return rev
+
   @staticmethod
   def findTmpDir():
-    for env in ('TMP', 'TEMP', 'TMPDIR'):
+    # Looks where svn (APR) puts its temporary files, so that xd_dir is on
+    # the same filesystem and they can be hard linked.
+    for env in ('TMPDIR', 'TMP', 'TEMP'):
       dirname = os.environ.get(env)
       if isWritableDir(dirname):
         return dirname
@@ -230,9 +786,260 @@ class Svn(Scm):
     return '%s__%s' % (parsed['path%s' % i],
                        revision and 'r' + revision or 'WC')
 
+  @classmethod
+  def getContentId(cls, parsed, i):
+    revision = filter(str.isdigit, parsed['revision%s' % i])
+    if revision:
+      return '%s@%s' % (parsed['path%s' % i], revision)
+    return super(Svn, cls).getContentId(parsed, i)
+
+  @staticmethod
+  def getBlobKey(parsed, i):
+    # Only pairs collected with their repository URL have one: a working
+    # copy path may be switched or checked out again from another branch.
+    # Working copy paths are fetched with their BASE revision as peg, which
+    # follows renames and copies back to the revision; the key has both.
+    revision = filter(str.isdigit, parsed['revision%s' % i])
+    if revision and parsed.get('url'):
+      if parsed.get('peg', revision) != revision:
+        return 'svn:%s@%s:%s' % (parsed['url'], parsed['peg'], revision)
+      return 'svn:%s@%s' % (parsed['url'], revision)
+    return None
+
+  @staticmethod
+  def getPairId(parsed):
+    return tuple(parsed[key] for key in ('path1', 'path2', 'revision1',
+                                         'revision2'))
+
   @staticmethod
   def setupExternalDiff(cmdline, env, xd=sys.argv[0]):
-    appendCmdline(cmdline, ['--diff-cmd', xd])
+    # svn runs in a process group of its own, off the terminal, where a
+    # password prompt would stop it.
+    appendCmdline(cmdline, ['--non-interactive', '--diff-cmd', xd])
+
+  @staticmethod
+  def parseDiffArgs(args):
+    # Returns (revision1, revision2, targets) for the 'svn diff' arguments
+    # collect() understands, where a revision of None stands for BASE on the
+    # left and for the working copy on the right, or None for anything else.
+    revision1 = revision2 = None
+    targets = []
+    i = 0
+    while i < len(args):
+      arg = args[i]
+      i += 1
+      name, value = arg, None
+      if arg.startswith('--') and '=' in arg:
+        name, value = arg.split('=', 1)
+      elif arg[:2] in ('-r', '-c') and len(arg) > 2:
+        name, value = arg[:2], arg[2:]
+      if name in ('-r', '--revision', '-c', '--change'):
+        if value is None:
+          if i == len(args):
+            return None
+          value = args[i]
+          i += 1
+        revisions = value.split(':')
+        if (revision1 is not None or len(revisions) > 2 or
+            not all(revision.isdigit() for revision in revisions)):
+          return None
+        if name in ('-c', '--change'):
+          if len(revisions) != 1 or revisions[0] == '0':
+            return None
+          revision1, revision2 = str(int(revisions[0]) - 1), revisions[0]
+        else:
+          revision1 = revisions[0]
+          revision2 = revisions[1:] and revisions[1] or None
+      elif arg == '--':
+        targets.extend(args[i:])
+        break
+      elif arg.startswith('-') or '://' in arg:
+        return None
+      else:
+        targets.append(arg)
+    return revision1, revision2, targets
+
+  @staticmethod
+  def runSvn(svn, args, env, job=None):
+    import subprocess
+    p = subprocess.Popen(svn + args,
+                         env=env,
+                         stdin=open(os.devnull),
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         close_fds=True)
+    output, error = communicateJob(p, job)
+    if p.returncode != 0:
+      raise IOError('%s: %s' % (' '.join(svn + args[:1]), error.strip()))
+    return output
+
+  @classmethod
+  def getInfo(cls, svn, paths, env, job=None):
+    import xml.etree.cElementTree as ElementTree
+    entries = {}
+    for i in xrange(0, len(paths), 256):
+      info = cls.runSvn(svn, ['info', '--xml', '--'] +
+                             [path + '@' for path in paths[i:i + 256]], env,
+                        job)
+      for entry in ElementTree.fromstring(info).iter('entry'):
+        entries[entry.get('path')] = (entry.get('revision'),
+                                      entry.findtext('url'))
+    return entries
+
+  @classmethod
+  def collect(cls, cmdline, env, xd_dir, job=None, previous=None):
+    import subprocess
+    import threading
+    import urllib
+    import xml.etree.cElementTree as ElementTree
+    if cmdline[1:2] != ['diff']:
+      return None
+    args = cls.parseDiffArgs(cmdline[2:])
+    if args is None:
+      return None
+    revision1, revision2, targets = args
+
+    svn = [cmdline[0], '--non-interactive']
+    open(os.path.join(xd_dir, 'STDOUT'), 'w').close()
+    start = traceStart()
+    p = subprocess.Popen(svn + ['diff', '--summarize', '--xml'] + cmdline[2:],
+                         env=env,
+                         stdin=open(os.devnull),
+                         stdout=subprocess.PIPE,
+                         close_fds=True)
+    summary = communicateJob(p, job)[0]
+    traceSpan('svn diff --summarize', start, returncode=p.returncode)
+    if p.returncode != 0:
+      if job is not None and job.cancelled:
+        return p.returncode
+      return None
+
+    # Repository to repository diffs list URLs, which are mapped back onto
+    # the targets they were found under.
+    target_urls = []
+    if revision2 is not None:
+      for path, (_, url) in cls.getInfo(svn, targets or ['.'], env,
+                                        job).items():
+        target_urls.append((url, path != '.' and path or ''))
+    stdout = open(os.path.join(xd_dir, 'STDOUT'), 'w')
+    changes = []
+    letters = {'added': 'A', 'deleted': 'D', 'modified': 'M', 'replaced': 'R'}
+    for element in ElementTree.fromstring(summary).iter('path'):
+      item = element.get('item')
+      source = path = element.text
+      for url, target in target_urls:
+        if path.startswith(url + '/') or path == url:
+          path = urllib.unquote(path[len(url) + 1:])
+          if target:
+            path = path and os.path.join(target, path) or target
+          break
+      print >>stdout, '%s%s      %s' % (
+          letters.get(item, ' '),
+          element.get('props') == 'modified' and 'M' or ' ', path)
+      if element.get('kind') == 'file' and item in letters:
+        changes.append((item, path, source))
+    stdout.close()
+    base = {}
+    if revision2 is None and changes:
+      base = cls.getInfo(svn, [path for _, path, _ in changes], env, job)
+
+    manifest = job is not None and job.manifest or Manifest(xd_dir)
+    store = BlobStore.open()
+    lock = threading.Lock()
+    state = {'next': 0, 'done': {}, 'appended': 0, 'error': None}
+
+    def fetch(item, path, source):
+      start = traceStart()
+      parsed = Pair(flags=['-u'], path=path, path1=path, path2=path)
+      for i, revision in ((1, revision1), (2, revision2)):
+        if (i == 1 and item == 'added') or (i == 2 and item == 'deleted'):
+          parsed['revision%s' % i] = '(nonexistent)'
+        elif i == 1 and revision is None:
+          parsed['revision%s' % i] = '(revision %s)' % base.get(path,
+                                                                 ('BASE',))[0]
+        elif revision is None:
+          parsed['revision%s' % i] = '(working copy)'
+        else:
+          parsed['revision%s' % i] = '(revision %s)' % revision
+        parsed['rev%s' % i] = cls.parseRevision(parsed['revision%s' % i])
+        parsed['label%s' % i] = '%s\t%s' % (path, parsed['revision%s' % i])
+      if previous and cls.getPairId(parsed) in previous:
+        return previous[cls.getPairId(parsed)]
+      if '://' in source:
+        parsed['url'] = source
+      elif base.get(path, (None, None))[1]:
+        parsed['peg'], parsed['url'] = base[path]
+      prefix = 'p%s' % manifest.reserveIndex()
+      for i, revision in ((1, revision1 or 'BASE'), (2, revision2)):
+        if parsed['revision%s' % i] == '(nonexistent)':
+          parsed['local_path%s' % i] = os.devnull
+        elif revision is None:
+          parsed['local_path%s' % i] = path
+        else:
+          local_path = cls.getXdDirPath(parsed, i, xd_dir, prefix)
+          key = store and cls.getBlobKey(parsed, i)
+          if not key or not store.link(key, local_path):
+            if '://' in source:
+              target = '%s@%s' % (source, revision)
+            else:
+              target = '%s@' % source
+            output = open(local_path, 'wb')
+            try:
+              p = subprocess.Popen(svn + ['cat', '-r', revision, '--', target],
+                                   env=env,
+                                   stdin=open(os.devnull),
+                                   stdout=output,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True)
+              error = communicateJob(p, job)[1]
+            finally:
+              output.close()
+            if p.returncode != 0:
+              raise IOError('svn cat %s: %s' % (target, error.strip()))
+            if key:
+              store.put(key, local_path)
+          parsed['local_path%s' % i] = local_path
+      cls.save(parsed, xd_dir, prefix)
+      traceSpan('collect pair', start, prefix=prefix, path=path)
+      return parsed
+
+    def work():
+      while True:
+        lock.acquire()
+        try:
+          index = state['next']
+          state['next'] += 1
+        finally:
+          lock.release()
+        if (index >= len(changes) or state['error'] is not None or
+            job is not None and job.cancelled):
+          return
+        try:
+          parsed = fetch(*changes[index])
+        except:
+          state['error'] = sys.exc_info()
+          return
+        lock.acquire()
+        try:
+          state['done'][index] = parsed
+          while state['appended'] in state['done']:
+            manifest.append(state['done'].pop(state['appended']))
+            state['appended'] += 1
+        finally:
+          lock.release()
+
+    threads = []
+    for _ in xrange(max(1, min(int(os.environ.get(XD_SVN_JOBS_ENV, 8)),
+                               len(changes)))):
+      thread = threading.Thread(target=work)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+    if state['error'] is not None:
+      raise state['error'][0], state['error'][1], state['error'][2]
+    return 0
 
 #------------------------------ scm git ------------------------------
 
@@ -252,15 +1059,21 @@ class Git(Scm):
     for l in xrange(min_len, 41):
       if parsed['hash1'][:l] != parsed['hash2'][:l]:
         return l
+    return min_len
 
   @classmethod
   def parseArgs(cls, argv=sys.argv):
-    parsed = {}
+    parsed = Pair()
     parsed['path'] = argv[-7]
     parsed['local_path1'], parsed['hash1'], parsed['mode1'] = argv[-6:-3]
     parsed['local_path2'], parsed['hash2'], parsed['mode2'] = argv[-3:]
     parsed['flags'] = argv[1:-7]
     parsed['path1'] = parsed['path2'] = parsed['path']
+    cls.setLabels(parsed)
+    return parsed
+
+  @classmethod
+  def setLabels(cls, parsed):
     l = cls.abbrHashLen(parsed)
     for i in (1, 2):
       hash = parsed['hash%s' % i]
@@ -272,8 +1085,8 @@ class Git(Scm):
         display_hash = 'hash %s' % hash[:l]
         if l < 40:
           display_hash += '...'
-      parsed['label%s' % i] = '%s\t(%s)' % (parsed['path'], display_hash)
-    return parsed
+      parsed['label%s' % i] = '%s\t(%s)' % (parsed['path%s' % i],
+                                              display_hash)
 
   @staticmethod
   def findTmpDir():
@@ -288,7 +1101,68 @@ class Git(Scm):
       display_hash = 'WC'
     else:
       display_hash = 'h%s' % hash[:cls.abbrHashLen(parsed)]
-    return '%s__%s' % (parsed['path'], display_hash)
+    return '%s__%s' % (parsed['path%s' % i], display_hash)
+
+  @classmethod
+  def getContentId(cls, parsed, i):
+    hash = parsed['hash%s' % i]
+    if hash != '0' * 40:
+      return hash
+    return super(Git, cls).getContentId(parsed, i)
+
+  @staticmethod
+  def getPairId(parsed):
+    return tuple(parsed[key] for key in ('path1', 'path2', 'mode1', 'mode2',
+                                         'hash1', 'hash2'))
+
+  @staticmethod
+  def getBlobKey(parsed, i):
+    hash = parsed['hash%s' % i]
+    if hash in ('.', '0' * 40):
+      return None
+    return hash
+
+  @classmethod
+  def isLazy(cls, parsed, i):
+    # With XD_LAZY set, blobs are only fetched once previewed or launched.
+    return bool(os.environ.get(XD_LAZY_ENV) and cls.getBlobKey(parsed, i) and
+                parsed['mode%s' % i] != '160000')
+
+  cat_file = None
+
+  cat_file_lock = thread.allocate_lock()
+
+  @classmethod
+  def fetch(cls, parsed, i):
+    # Several threads may fetch the same side; each writes its own temporary
+    # file and the last rename wins with the same content.  They share one
+    # 'git cat-file --batch' under cat_file_lock.
+    hash = parsed['hash%s' % i]
+    path = parsed['xd_dir_path%s' % i]
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), thread.get_ident())
+    start = traceStart()
+    store = BlobStore.open()
+    try:
+      if store is None or not store.link(hash, tmp_path):
+        lock = cls.cat_file_lock
+        lock.acquire()
+        try:
+          if cls.cat_file is None:
+            cls.cat_file = GitCatFile()
+          try:
+            cls.cat_file.fetch(hash, tmp_path)
+          except IOError:
+            cls.cat_file = None
+            raise
+        finally:
+          lock.release()
+        if store is not None:
+          store.put(hash, tmp_path)
+      os.rename(tmp_path, path)
+    finally:
+      if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    traceSpan('fetch lazy', start, path=parsed['path'])
 
   @classmethod
   def setupCmdLine(cls, argv):
@@ -299,55 +1173,1211 @@ class Git(Scm):
     appendCmdline(cmdline, '--ext-diff')
     env['GIT_EXTERNAL_DIFF'] = xd
 
+  raw_options = ('--cached', '--staged', '--merge-base', '--no-renames', '-R',
+                 '-M', '--find-renames', '-C', '--find-copies')
+
+  @classmethod
+  def parseRaw(cls, raw):
+    fields = raw.split('\0')
+    i = 0
+    while i < len(fields) and fields[i].startswith(':'):
+      mode1, mode2, hash1, hash2, status = fields[i][1:].split(' ')
+      if status[0] in 'RC':
+        path1, path2 = fields[i + 1:i + 3]
+        i += 3
+      else:
+        path1 = path2 = fields[i + 1]
+        i += 2
+      if status[0] == 'U':
+        continue
+      parsed = Pair(mode1=mode1, mode2=mode2, hash1=hash1, hash2=hash2,
+                    path1=path1, path2=path2, flags=[], status=status[0])
+      if path1 == path2:
+        parsed['path'] = path1
+      else:
+        parsed['path'] = '%s (VS) %s' % (path1, path2)
+      for j in (1, 2):
+        if parsed['mode%s' % j] == '000000':
+          parsed['hash%s' % j] = parsed['mode%s' % j] = '.'
+      yield parsed
+    if i < len(fields) and fields[i]:
+      raise ValueError('unexpected git diff --raw output: %r' % fields[i])
+
+  @staticmethod
+  def isWorkTreeHash(parsed, i, toplevel):
+    # With -M or -C, git reports the hashes of the changed working tree files
+    # it read to find renames, though they are not in the object database.
+    # Only such sides, which cat-file cannot fetch, are read from the checkout.
+    path = os.path.join(toplevel, parsed['path%s' % i])
+    return (parsed.get('status') in ('R', 'C') and os.path.isfile(path) and
+            getGitHash(path) == parsed['hash%s' % i])
+
+  @classmethod
+  def collect(cls, cmdline, env, xd_dir, job=None, previous=None):
+    import subprocess
+    import time
+    if cmdline[1:2] != ['diff']:
+      return None
+    for arg in cmdline[2:]:
+      if arg == '--':
+        break
+      if (arg.startswith('-') and arg not in cls.raw_options and
+          arg.split('=', 1)[0] not in cls.raw_options and
+          arg[:2] not in ('-M', '-C')):
+        return None
+
+    p = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'], env=env,
+                         stdout=subprocess.PIPE, close_fds=True)
+    toplevel = p.communicate()[0].rstrip('\n')
+    if p.returncode != 0:
+      return None
+    open(os.path.join(xd_dir, 'STDOUT'), 'w').close()
+    start = traceStart()
+    p = subprocess.Popen(cmdline[:2] + ['--raw', '-z', '--no-abbrev',
+                                        '--no-color'] + cmdline[2:],
+                         env=env,
+                         stdin=open(os.devnull),
+                         stdout=subprocess.PIPE,
+                         close_fds=True)
+    raw = communicateJob(p, job)[0]
+    traceSpan('git diff --raw', start, returncode=p.returncode)
+    if p.returncode != 0:
+      return p.returncode
+
+    manifest = job is not None and job.manifest or Manifest(xd_dir)
+    store = BlobStore.open()
+    cat_file = None
+    pending = []
+    flushed = time.time()
+    reserved = 0
+    try:
+      for parsed in cls.parseRaw(raw):
+        if job is not None and job.cancelled:
+          break
+        if pending and (len(pending) >= MANIFEST_CHUNK or
+                        time.time() - flushed > 0.1):
+          manifest.extend(pending)
+          pending = []
+          flushed = time.time()
+        if previous and cls.getPairId(parsed) in previous:
+          pending.append(previous[cls.getPairId(parsed)])
+          continue
+        start = traceStart()
+        cls.setLabels(parsed)
+        if not reserved:
+          index = manifest.reserveIndex(MANIFEST_CHUNK)
+          reserved = MANIFEST_CHUNK
+        prefix = 'p%s' % index
+        index += 1
+        reserved -= 1
+        for i in (1, 2):
+          hash = parsed['hash%s' % i]
+          if hash == '.':
+            parsed['local_path%s' % i] = os.devnull
+          elif hash == '0' * 40 and parsed['mode%s' % i] == '120000':
+            # Like git's external diff, show the target of a symlink rather
+            # than the file it points to.
+            local_path = cls.getXdDirPath(parsed, i, xd_dir, prefix)
+            open(local_path, 'w').write(os.readlink(
+                os.path.join(toplevel, parsed['path%s' % i])))
+            parsed['local_path%s' % i] = local_path
+          elif hash == '0' * 40:
+            parsed['local_path%s' % i] = os.path.join(toplevel,
+                                                      parsed['path%s' % i])
+          elif (cls.isLazy(parsed, i) and
+                not cls.isWorkTreeHash(parsed, i, toplevel)):
+            parsed['local_path%s' % i] = None
+          else:
+            local_path = cls.getXdDirPath(parsed, i, xd_dir, prefix)
+            if parsed['mode%s' % i] == '160000':
+              print >>open(local_path, 'w'), 'Subproject commit %s' % hash
+            elif store is None or not store.link(hash, local_path):
+              if cat_file is None:
+                cat_file = GitCatFile(env)
+                if job is not None:
+                  job.attach(cat_file.process)
+              try:
+                cat_file.fetch(hash, local_path)
+              except IOError:
+                if not cls.isWorkTreeHash(parsed, i, toplevel):
+                  raise
+                local_path = os.path.join(toplevel, parsed['path%s' % i])
+              else:
+                if store is not None:
+                  store.put(hash, local_path)
+            parsed['local_path%s' % i] = local_path
+        cls.save(parsed, xd_dir, prefix)
+        pending.append(parsed)
+        traceSpan('collect pair', start, prefix=prefix, path=parsed['path'])
+    finally:
+      if pending:
+        manifest.extend(pending)
+      if cat_file is not None:
+        cat_file.close()
+        if job is not None:
+          job.detach(cat_file.process)
+    return 0
+
+
+class GitCatFile(object):
+
+  def __init__(self, env=None):
+    import subprocess
+    self.process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                    env=env,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    close_fds=True)
+
+  def fetch(self, hash, path):
+    self.process.stdin.write(hash + '\n')
+    self.process.stdin.flush()
+    header = self.process.stdout.readline().split()
+    if len(header) != 3:
+      raise IOError('git cat-file: cannot read object %s' % hash)
+    size = int(header[2])
+    f = open(path, 'wb')
+    try:
+      while size > 0:
+        data = self.process.stdout.read(min(size, 1024 * 1024))
+        if not data:
+          raise IOError('git cat-file: truncated object %s' % hash)
+        f.write(data)
+        size -= len(data)
+    finally:
+      f.close()
+    self.process.stdout.read(1)
+
+  def close(self):
+    self.process.stdin.close()
+    self.process.wait()
+
 #------------------------------ diff tools ------------------------------
 
+DIFF_SERVER_TIMEOUT = 60
+
 def initDiffTool():
 
   import shlex
+  import threading
 
   class DiffTool(object):
 
+    # Tools with a server command keep an editor running and only hand it
+    # each pair: probe exits with 0 once the server answers, and command
+    # waits until the pair is closed in the editor.  The server is started
+    # the first time the tool is selected or launched and is left running for
+    # later sessions.
+
     all = []
 
-    def __init__(self, command, name=None):
+    def __init__(self, command, name=None, server=None, probe=None):
       self.command = command
       self.commands = shlex.split(command)
       self.name = name or self.commands[0]
+      self.server = server
+      self.probe = probe
       self.installed = None
+      self.lock = threading.Lock()
       DiffTool.all.append(self)
 
     def isInstalled(self, refresh=False):
       if refresh or self.installed is None:
-        self.installed = which(self.commands[0]) is not None
+        programs = [self.commands[0]]
+        if self.server is not None:
+          programs.append(shlex.split(self.server)[0])
+        self.installed = not [program for program in programs
+                              if which(program) is None]
       return self.installed
 
     def launch(self, parsed):
-      return self.launchCustom(self.command, parsed)
+      if self.server is None:
+        return self.launchCustom(self.command, parsed)
+      thread = threading.Thread(target=self.serve, args=(parsed,))
+      thread.setDaemon(True)
+      thread.start()
+      return thread
+
+    def warm(self):
+      if self.server is not None and self.isInstalled():
+        thread = threading.Thread(target=self.serve)
+        thread.setDaemon(True)
+        thread.start()
+
+    def isServing(self):
+      import subprocess
+      devnull = open(os.devnull, 'w')
+      return subprocess.call(self.probe, stdin=devnull, stdout=devnull,
+                             stderr=devnull, close_fds=True, shell=True) == 0
+
+    def serve(self, parsed=None):
+      # Runs in a thread of its own: starts the server unless one answers
+      # already, waits for it and hands it the pair, if any.
+      import subprocess
+      import time
+      self.lock.acquire()
+      try:
+        if not self.isServing():
+          start = traceStart()
+          subprocess.Popen(self.server, stdin=open(os.devnull),
+                           close_fds=True, shell=True)
+          deadline = time.time() + DIFF_SERVER_TIMEOUT
+          while not self.isServing() and time.time() < deadline:
+            time.sleep(0.1)
+          traceSpan('start diff server', start, tool=self.name)
+      finally:
+        self.lock.release()
+      if parsed is not None:
+        self.launchCustom(self.command, parsed).wait()
 
     @staticmethod
     def launchCustom(command, parsed):
+      import string
+      import subprocess
       return subprocess.Popen(
-          string.Template(command).safe_substitute(parsed),
+          string.Template(command).safe_substitute(
+              parsed.getSubstitutions()),
           close_fds=True,
           shell=True)
 
   DiffTool('tkdiff -L $l1 -L $l2 -- $f1 $f2')
   DiffTool('xxdiff --title1 $l1 --title2 $l2 -- $f1 $f2')
-  DiffTool('gvimdiff -- $f1 $f2')
+  DiffTool('gvimdiff -f -- $f1 $f2')
+  DiffTool('gvim --servername XD --remote-tab-wait-silent '
+           '+\'vert diffsplit \'$v2 $f1',
+           'gvimdiff(server)', server='gvim --servername XD',
+           probe='gvim --servername XD --remote-expr 1')
   DiffTool('emacs --eval \'(ediff "$f1" "$f2")\'', 'emacs(ediff)')
+  DiffTool('emacsclient -s xd -c --eval \'(ediff "$f1" "$f2")\'',
+           'emacsclient(ediff)', server='emacs --daemon=xd',
+           probe='emacsclient -s xd --eval t')
   DiffTool('xemacs --eval \'(ediff "$f1" "$f2")\'', 'xemacs(ediff)')
   DiffTool('meld -L $l1 -L $l2 -- $f1 $f2')
+  DiffTool('meld --newtab -L $l1 -L $l2 -- $f1 $f2', 'meld(tab)')
   DiffTool('diffuse $f1 $f2')
   DiffTool('kompare -- $f1 $f2')
   DiffTool('kdiff3 -L1 $l1 -L2 $l2 -- $f1 $f2')
 
   return DiffTool
 
+
+class ToolManager(object):
+
+  # Runs the diff tools of pairs, named by their (xd_dir_path1,
+  # xd_dir_path2), at most max_running at a time; the others wait in order.
+  # launch functions return a Popen or, for tools with a server, the thread
+  # waiting for the pair to be closed.  The GUI calls reap() from its event
+  # loop, which waits for the tools that exited and starts the next ones.
+
+  def __init__(self, max_running):
+    self.max_running = max(1, max_running)
+    self.running = []
+    self.queued = []
+
+  def __contains__(self, names):
+    return names in self.getOpen() or names in [n for n, _ in self.queued]
+
+  def submit(self, names, launch):
+    if names not in self:
+      self.queued.append((names, launch))
+      self.start()
+
+  def start(self):
+    while self.queued and len(self.running) < self.max_running:
+      names, launch = self.queued.pop(0)
+      self.running.append((names, launch()))
+
+  def reap(self):
+    # Returns whether any tool exited.
+    import threading
+    running = []
+    for names, process in self.running:
+      if isinstance(process, threading.Thread):
+        if process.isAlive():
+          running.append((names, process))
+      elif process.poll() is None:
+        running.append((names, process))
+    reaped = len(running) < len(self.running)
+    self.running = running
+    self.start()
+    return reaped
+
+  def getOpen(self):
+    return set(names for names, _ in self.running)
+
+#------------------------------ diff engines ------------------------------
+
+class DifflibEngine(object):
+
+  name = 'difflib'
+
+  max_size = 4 * 1024 * 1024
+
+  max_line_len = 1024
+
+  @staticmethod
+  def getMatchingBlocks(lines1, lines2, job=None):
+    import difflib
+    matcher = difflib.SequenceMatcher(None, lines1, lines2)
+    return [tuple(block) for block in matcher.get_matching_blocks()]
+
+
+class FastEngine(object):
+
+  # Interns lines to integers and strips the common prefix and suffix, then
+  # aligns the rest on lines occurring exactly once on both sides (patience
+  # diff).  Stretches without such lines go to a Myers diff; if that costs
+  # more than max_cost edits the stretch is reported as replaced as a whole.
+
+  name = 'fast'
+
+  max_size = 32 * 1024 * 1024
+
+  max_line_len = 8192
+
+  max_cost = 1024
+
+  @staticmethod
+  def intern(lines1, lines2):
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in lines1]
+    b = [ids.setdefault(line, len(ids)) for line in lines2]
+    return a, b
+
+  @staticmethod
+  def getUniqueAnchors(a, b, alo, ahi, blo, bhi):
+    import bisect
+    index1 = {}
+    for i in xrange(alo, ahi):
+      if a[i] in index1:
+        index1[a[i]] = -1
+      else:
+        index1[a[i]] = i
+    index2 = {}
+    for j in xrange(blo, bhi):
+      if index1.get(b[j], -1) >= 0:
+        if b[j] in index2:
+          index2[b[j]] = -1
+        else:
+          index2[b[j]] = j
+    pairs = [(j, index1[line]) for line, j in index2.iteritems() if j >= 0]
+    pairs.sort()
+
+    tails = []
+    tail_values = []
+    previous = []
+    for k, (j, i) in enumerate(pairs):
+      pos = bisect.bisect_left(tail_values, i)
+      previous.append(tails[pos - 1] if pos else None)
+      if pos == len(tails):
+        tails.append(k)
+        tail_values.append(i)
+      else:
+        tails[pos] = k
+        tail_values[pos] = i
+    anchors = []
+    if tails:
+      k = tails[-1]
+      while k is not None:
+        anchors.append((pairs[k][1], pairs[k][0]))
+        k = previous[k]
+      anchors.reverse()
+    return anchors
+
+  @classmethod
+  def getMyersBlocks(cls, a, b, alo, ahi, blo, bhi, job=None):
+    n = ahi - alo
+    m = bhi - blo
+    counts = {}
+    for i in xrange(alo, ahi):
+      counts[a[i]] = counts.get(a[i], 0) + 1
+    common = 0
+    for j in xrange(blo, bhi):
+      if counts.get(b[j]):
+        counts[b[j]] -= 1
+        common += 1
+    if n + m - 2 * common > cls.max_cost:
+      return []
+    max_d = min(n + m, cls.max_cost)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in xrange(max_d + 1):
+      if job is not None and job.cancelled:
+        return []
+      trace.append(v[offset - d - 1:offset + d + 2])
+      for k in xrange(-d, d + 1, 2):
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+          x = v[offset + k + 1]
+        else:
+          x = v[offset + k - 1] + 1
+        y = x - k
+        while x < n and y < m and a[alo + x] == b[blo + y]:
+          x += 1
+          y += 1
+        v[offset + k] = x
+        if x >= n and y >= m:
+          break
+      else:
+        continue
+      break
+    else:
+      return []
+
+    blocks = []
+    x, y = n, m
+    for d in xrange(len(trace) - 1, -1, -1):
+      v = trace[d]
+      k = x - y
+      if k == -d or (k != d and v[k + d] < v[k + d + 2]):
+        previous_k = k + 1
+      else:
+        previous_k = k - 1
+      previous_x = v[previous_k + d + 1]
+      previous_y = previous_x - previous_k
+      size = min(x - max(previous_x, 0), y - max(previous_y, 0))
+      if size > 0:
+        blocks.append((alo + x - size, blo + y - size, size))
+      x, y = previous_x, previous_y
+    blocks.reverse()
+    return blocks
+
+  @classmethod
+  def getMatchingBlocks(cls, lines1, lines2, job=None):
+    a, b = cls.intern(lines1, lines2)
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+      if job is not None and job.cancelled:
+        return None
+      item = stack.pop()
+      if len(item) == 3:
+        blocks.append(item)
+        continue
+      alo, ahi, blo, bhi = item
+
+      i, j = alo, blo
+      while i < ahi and j < bhi and a[i] == b[j]:
+        i += 1
+        j += 1
+      if i > alo:
+        blocks.append((alo, blo, i - alo))
+      alo, blo = i, j
+      i, j = ahi, bhi
+      while i > alo and j > blo and a[i - 1] == b[j - 1]:
+        i -= 1
+        j -= 1
+      if i < ahi:
+        stack.append((i, j, ahi - i))
+      ahi, bhi = i, j
+      if alo == ahi or blo == bhi:
+        continue
+
+      anchors = cls.getUniqueAnchors(a, b, alo, ahi, blo, bhi)
+      if anchors:
+        items = []
+        size = 0
+        for i, j in anchors:
+          if size and run_i + size == i and run_j + size == j:
+            size += 1
+            continue
+          if size:
+            items.append((run_i, run_j, size))
+            alo, blo = run_i + size, run_j + size
+          if alo < i or blo < j:
+            items.append((alo, i, blo, j))
+          run_i, run_j, size = i, j, 1
+        items.append((run_i, run_j, size))
+        alo, blo = run_i + size, run_j + size
+        if alo < ahi or blo < bhi:
+          items.append((alo, ahi, blo, bhi))
+        items.reverse()
+        stack.extend(items)
+      else:
+        blocks.extend(cls.getMyersBlocks(a, b, alo, ahi, blo, bhi, job))
+
+    merged = []
+    for i, j, size in blocks:
+      if merged and merged[-1][0] + merged[-1][2] == i and \
+          merged[-1][1] + merged[-1][2] == j:
+        merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+      else:
+        merged.append((i, j, size))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+
+DIFF_ENGINES = (FastEngine, DifflibEngine)
+
+def getDiffEngine(name=None):
+  name = name or os.environ.get(XD_DIFF_ENGINE_ENV, FastEngine.name)
+  for engine in DIFF_ENGINES:
+    if engine.name == name:
+      return engine
+  return FastEngine
+
+
+def getOpcodes(blocks):
+  opcodes = []
+  i = j = 0
+  for ai, bj, size in blocks:
+    if i < ai and j < bj:
+      opcodes.append(('replace', i, ai, j, bj))
+    elif i < ai:
+      opcodes.append(('delete', i, ai, j, bj))
+    elif j < bj:
+      opcodes.append(('insert', i, ai, j, bj))
+    i, j = ai + size, bj + size
+    if size:
+      opcodes.append(('equal', ai, i, bj, j))
+  return opcodes
+
+
+def groupOpcodes(opcodes, n=3):
+  codes = opcodes or [('equal', 0, 1, 0, 1)]
+  if codes[0][0] == 'equal':
+    tag, i1, i2, j1, j2 = codes[0]
+    codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+  if codes[-1][0] == 'equal':
+    tag, i1, i2, j1, j2 = codes[-1]
+    codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+  group = []
+  for tag, i1, i2, j1, j2 in codes:
+    if tag == 'equal' and i2 - i1 > n + n:
+      group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+      yield group
+      group = []
+      i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+    group.append((tag, i1, i2, j1, j2))
+  if group and not (len(group) == 1 and group[0][0] == 'equal'):
+    yield group
+
+
+def formatRange(start, stop):
+  length = stop - start
+  if length == 1:
+    return '%d' % (start + 1)
+  if not length:
+    return '%d,0' % start
+  return '%d,%d' % (start + 1, length)
+
+
+def unifiedDiff(lines1, lines2, blocks, n=3):
+  for group in groupOpcodes(getOpcodes(blocks), n):
+    yield '@@ -%s +%s @@\n' % (formatRange(group[0][1], group[-1][2]),
+                               formatRange(group[0][3], group[-1][4]))
+    for tag, i1, i2, j1, j2 in group:
+      if tag == 'equal':
+        for line in lines1[i1:i2]:
+          yield ' ' + line
+        continue
+      if tag in ('replace', 'delete'):
+        for line in lines1[i1:i2]:
+          yield '-' + line
+      if tag in ('replace', 'insert'):
+        for line in lines2[j1:j2]:
+          yield '+' + line
+
+#------------------------------ preview ------------------------------
+
+MAX_PREFETCH_SIZE = 1024 * 1024
+
+RENDER_SLICE = 2000
+
+PROBE_SIZE = 8192
+
+def probeFile(path, max_line_len):
+  # Classifies a file without reading it all: returns (size, is_text,
+  # long_line), where is_text is judged on the first PROBE_SIZE bytes and
+  # long_line is the length of the longest line above max_line_len, or 0.
+  # Any such line spans a whole window of max_line_len / 2 bytes without a
+  # newline, so only those windows need a closer look.
+  import mmap
+  f = open(path, 'rb')
+  try:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return 0, True, 0
+    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+  try:
+    if not isText([m[:PROBE_SIZE]]):
+      return size, False, 0
+    window = max(1, max_line_len / 2)
+    long_line = 0
+    pos = 0
+    while pos < size:
+      if m.find('\n', pos, pos + window) != -1:
+        pos += window
+        continue
+      start = m.rfind('\n', 0, pos) + 1
+      end = m.find('\n', pos)
+      end = end == -1 and size or end + 1
+      if end - start > max_line_len:
+        long_line = max(long_line, end - start)
+      pos = end
+    return size, True, long_line
+  finally:
+    m.close()
+
+def checkFiles(path1, path2, engine):
+  # Returns None when engine can diff the files, otherwise why not ('too-big',
+  # 'binary' or 'long-lines') and the preview lines saying so.
+  size1 = os.path.getsize(path1)
+  size2 = os.path.getsize(path2)
+  if size1 > engine.max_size or size2 > engine.max_size:
+    return 'too-big', [' Files are too big (>%d) to diff\n' % engine.max_size,
+                       '-file size 1: %d\n' % size1,
+                       '+file size 2: %d\n' % size2]
+
+  start = traceStart()
+  size1, text1, long_line1 = probeFile(path1, engine.max_line_len)
+  size2, text2, long_line2 = probeFile(path2, engine.max_line_len)
+  traceSpan('probe', start, size1=size1, size2=size2)
+  if not text1 or not text2:
+    return 'binary', [' Binary files diff\n']
+  if long_line1 or long_line2:
+    within = '<=%d' % engine.max_line_len
+    return 'long-lines', [
+        ' Lines are too long (>%d) to diff\n' % engine.max_line_len,
+        '-max line length 1: %s\n' % (long_line1 or within),
+        '+max line length 2: %s\n' % (long_line2 or within)]
+  return None
+
+def matchFiles(path1, path2, job=None, engine=None):
+  # Returns (check, lines1, lines2, blocks), where check is what checkFiles
+  # returned and the rest is only set when it is None, or None if job was
+  # cancelled.
+  engine = engine or getDiffEngine()
+
+  check = checkFiles(path1, path2, engine)
+  if check is not None:
+    return check, None, None, None
+  if job is not None and job.cancelled:
+    return None
+
+  start = traceStart()
+  lines1 = open(path1).readlines()
+  lines2 = open(path2).readlines()
+  traceSpan('read', start, lines1=len(lines1), lines2=len(lines2))
+  start = traceStart()
+  blocks = engine.getMatchingBlocks(lines1, lines2, job)
+  traceSpan('match', start, engine=engine.name)
+  if blocks is None or job is not None and job.cancelled:
+    return None
+  return None, lines1, lines2, blocks
+
+def formatDiff(matched):
+  if matched is None:
+    return None
+  check, lines1, lines2, blocks = matched
+  if check is not None:
+    return check[1]
+  start = traceStart()
+  results = list(unifiedDiff(lines1, lines2, blocks))
+  traceSpan('format', start, lines=len(results))
+  return results
+
+def diffFiles(path1, path2, job=None, engine=None):
+  return formatDiff(matchFiles(path1, path2, job, engine))
+
+def getDiffStat(matched):
+  # Returns (kind, removed, added) for what matchFiles returned, where kind is
+  # None or why the files were not diffed.
+  check, lines1, lines2, blocks = matched
+  if check is not None:
+    return check[0], 0, 0
+  removed = added = 0
+  for tag, i1, i2, j1, j2 in getOpcodes(blocks):
+    if tag != 'equal':
+      removed += i2 - i1
+      added += j2 - j1
+  return None, removed, added
+
+
+INTRALINE_MIN_RATIO = 0.5
+
+def getChangeBlocks(lines):
+  # Finds the runs of '-' lines directly followed by '+' lines in unified diff
+  # output, as (start, deleted, added) tuples in order of start.
+  blocks = []
+  i = 0
+  n = len(lines)
+  while i < n:
+    if lines[i][:1] != '-':
+      i += 1
+      continue
+    start = i
+    while i < n and lines[i][:1] == '-':
+      i += 1
+    deleted = i - start
+    while i < n and lines[i][:1] == '+':
+      i += 1
+    if i - start > deleted:
+      blocks.append((start, deleted, i - start - deleted))
+  return blocks
+
+def getIntralineRanges(line1, line2):
+  # Returns the (start, end) character ranges that differ between two paired
+  # lines, word by word, as (ranges1, ranges2), or None when the lines have
+  # too little in common for the ranges to help.
+  import re
+  tokens1 = re.findall(r'\w+|\s+|.', line1, re.U)
+  tokens2 = re.findall(r'\w+|\s+|.', line2, re.U)
+  n = min(len(tokens1), len(tokens2))
+  lo = 0
+  while lo < n and tokens1[lo] == tokens2[lo]:
+    lo += 1
+  hi = 0
+  while hi < n - lo and tokens1[-1 - hi] == tokens2[-1 - hi]:
+    hi += 1
+  middle1 = tokens1[lo:len(tokens1) - hi]
+  middle2 = tokens2[lo:len(tokens2) - hi]
+  offset = sum(len(token) for token in tokens1[:lo])
+  offsets1 = [offset]
+  for token in middle1:
+    offsets1.append(offsets1[-1] + len(token))
+  offsets2 = [offset]
+  for token in middle2:
+    offsets2.append(offsets2[-1] + len(token))
+
+  ranges1 = []
+  ranges2 = []
+  common = len(line1) - (offsets1[-1] - offset)
+  blocks = FastEngine.getMatchingBlocks(middle1, middle2)
+  for tag, i1, i2, j1, j2 in getOpcodes(blocks):
+    if tag == 'equal':
+      common += offsets1[i2] - offsets1[i1]
+      continue
+    if i1 < i2:
+      ranges1.append((offsets1[i1], offsets1[i2]))
+    if j1 < j2:
+      ranges2.append((offsets2[j1], offsets2[j2]))
+  if 2 * common < (len(line1) + len(line2)) * INTRALINE_MIN_RATIO:
+    return None
+  return ranges1, ranges2
+
+
+class PreviewCache(object):
+
+  # Keeps computed previews keyed by the content identity of both sides, and
+  # evicts the least recently used ones once their total size exceeds
+  # max_size bytes.  The diffstats of all pairs diffed so far are kept too,
+  # whether for a preview or for the file list.
+
+  def __init__(self, max_size=64 * 1024 * 1024):
+    import threading
+    self.max_size = max_size
+    self.size = 0
+    self.tick = 0
+    self.entries = {}
+    self.stats = {}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def getSize(results):
+    return sum([len(line) + 40 for line in results])
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key):
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      self.tick += 1
+      entry[0] = self.tick
+      return entry[2]
+    finally:
+      self.lock.release()
+
+  def put(self, key, results):
+    size = self.getSize(results)
+    if size > self.max_size:
+      return
+    self.lock.acquire()
+    try:
+      if key in self.entries:
+        self.size -= self.entries[key][1]
+      self.tick += 1
+      self.entries[key] = [self.tick, size, results]
+      self.size += size
+      while self.size > self.max_size:
+        _, oldest = min([(entry[0], k)
+                         for k, entry in self.entries.iteritems()])
+        self.size -= self.entries.pop(oldest)[1]
+    finally:
+      self.lock.release()
+
+  def getStat(self, key):
+    return self.stats.get(key)
+
+  def diff(self, key, path1, path2, job=None):
+    matched = matchFiles(path1, path2, job)
+    results = formatDiff(matched)
+    if results is not None and None not in key:
+      self.put(key, results)
+      self.stats[key] = getDiffStat(matched)
+    return results
+
+  def getChanges(self, key, path1, path2, job=None):
+    # Returns the diffstat of a pair and its removed and added lines, taken
+    # from the cached preview if there is one, or None if job was cancelled.
+    # Otherwise the preview is formatted and cached as well, so selecting the
+    # pair later does not diff it again.
+    stat = self.stats.get(key)
+    if stat is not None:
+      results = self.get(key)
+      if results is not None:
+        if stat[0] is not None:
+          return stat, []
+        return stat, [line[1:] for line in results
+                      if line[:1] == '-' or line[:1] == '+']
+    matched = matchFiles(path1, path2, job)
+    if matched is None:
+      return None
+    stat = getDiffStat(matched)
+    if None not in key:
+      self.put(key, formatDiff(matched))
+      self.stats[key] = stat
+    check, lines1, lines2, blocks = matched
+    changed = []
+    if check is None:
+      for tag, i1, i2, j1, j2 in getOpcodes(blocks):
+        if tag != 'equal':
+          changed.extend(lines1[i1:i2])
+          changed.extend(lines2[j1:j2])
+    return stat, changed
+
+
+class PreviewJob(object):
+
+  def __init__(self, function, args):
+    self.function = function
+    self.args = args
+    self.cancelled = False
+    self.done = False
+    self.result = None
+    self.error = None
+
+  def cancel(self):
+    self.cancelled = True
+
+  def run(self):
+    if not self.cancelled:
+      try:
+        self.result = self.function(*self.args + (self,))
+      except:
+        import traceback
+        self.error = traceback.format_exc()
+    self.done = True
+
+
+class PreviewWorker(object):
+
+  # Computes previews in background threads so that the Tk main loop stays
+  # responsive; the GUI polls PreviewJob.done with after().  A cancelled job
+  # cannot always be interrupted, so another thread is started when none is
+  # idle, up to max_threads.  Speculative jobs from submitBackground only run
+  # when no other job is waiting, and never more than one at a time; those
+  # from submitPrefetch go before them, so that indexing does not hold back
+  # the preview of the next rows.
+
+  def __init__(self, max_threads=4):
+    import threading
+    self.jobs = []
+    self.background_jobs = []
+    self.prefetch_jobs = []
+    self.background_running = False
+    self.idle = 0
+    self.threads = 0
+    self.max_threads = max_threads
+    self.stopped = False
+    self.condition = threading.Condition()
+
+  def startThread(self):
+    import threading
+    thread = threading.Thread(target=self.run)
+    thread.setDaemon(True)
+    thread.start()
+    self.threads += 1
+
+  def submit(self, function, *args):
+    job = PreviewJob(function, args)
+    self.condition.acquire()
+    try:
+      self.jobs.append(job)
+      if self.idle == 0 and self.threads < self.max_threads:
+        self.startThread()
+      self.condition.notify()
+    finally:
+      self.condition.release()
+    return job
+
+  def submitBackground(self, function, *args):
+    return self.queueBackground(self.background_jobs, function, args)
+
+  def submitPrefetch(self, function, *args):
+    return self.queueBackground(self.prefetch_jobs, function, args)
+
+  def queueBackground(self, queue, function, args):
+    job = PreviewJob(function, args)
+    self.condition.acquire()
+    try:
+      queue.append(job)
+      if self.threads == 0:
+        self.startThread()
+      self.condition.notify()
+    finally:
+      self.condition.release()
+    return job
+
+  def promote(self, job):
+    self.condition.acquire()
+    try:
+      for queue in (self.prefetch_jobs, self.background_jobs):
+        if job not in queue:
+          continue
+        queue.remove(job)
+        self.jobs.append(job)
+        if self.idle == 0 and self.threads < self.max_threads:
+          self.startThread()
+        self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def stop(self):
+    self.condition.acquire()
+    try:
+      self.stopped = True
+      for job in self.jobs + self.prefetch_jobs + self.background_jobs:
+        job.cancel()
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def run(self):
+    while True:
+      self.condition.acquire()
+      try:
+        self.idle += 1
+        while not (self.jobs or self.stopped or
+                   ((self.prefetch_jobs or self.background_jobs) and
+                    not self.background_running)):
+          self.condition.wait()
+        self.idle -= 1
+        if self.stopped:
+          return
+        background = not self.jobs
+        if background:
+          job = (self.prefetch_jobs or self.background_jobs).pop(0)
+          self.background_running = True
+        else:
+          job = self.jobs.pop(0)
+      finally:
+        self.condition.release()
+      job.run()
+      if background:
+        self.condition.acquire()
+        try:
+          self.background_running = False
+          self.condition.notify()
+        finally:
+          self.condition.release()
+
+#------------------------------ search ------------------------------
+
+SEARCH_CHUNK = 50
+
+class SearchIndex(object):
+
+  # Inverted index from the words of changed lines to the pairs changing
+  # them, named by their (xd_dir_path1, xd_dir_path2).  Pairs are added from
+  # background jobs, which also leave their diffstats in the PreviewCache, and
+  # indexed again only when one side changed size or mtime.  The names of
+  # the pairs looked at since the last takeIndexed() let the GUI update just
+  # their rows.  Substring lookups go through the trigrams of the words, and
+  # the pairs found for a part are kept up to date as pairs are added, so the
+  # filter does not look again at every refresh while indexing.
+
+  max_found = 64
+
+  def __init__(self):
+    import threading
+    self.words = {}
+    self.pair_words = {}
+    self.stamps = {}
+    self.trigrams = {}
+    self.short_words = set()
+    self.found = {}
+    self.pending = 0
+    self.indexed = []
+    self.lock = threading.Lock()
+
+  def __contains__(self, names):
+    return names in self.stamps
+
+  @staticmethod
+  def getStamp(names):
+    stamp = []
+    for path in names:
+      try:
+        st = os.stat(path)
+      except OSError:
+        return None
+      stamp.append((st.st_size, st.st_mtime))
+    return tuple(stamp)
+
+  def submit(self, worker, cache, items):
+    # Indexes the (names, key) items, key being the PreviewCache key.
+    self.lock.acquire()
+    try:
+      self.pending += len(items)
+    finally:
+      self.lock.release()
+    for i in xrange(0, len(items), SEARCH_CHUNK):
+      worker.submitBackground(self.add, items[i:i + SEARCH_CHUNK], cache)
+
+  def add(self, items, cache, job=None):
+    import re
+    for i, (names, key) in enumerate(items):
+      stamp = self.getStamp(names)
+      words = None
+      if stamp is not None and (stamp != self.stamps.get(names) or
+                                cache.getStat(key) is None):
+        try:
+          changes = cache.getChanges(key, names[0], names[1], job)
+        except (IOError, OSError):
+          # Pairs that cannot be read count as done, like missing ones.
+          stamp = changes = None
+        if stamp is not None:
+          if changes is None or job is not None and job.cancelled:
+            self.done(len(items) - i)
+            return None
+          words = frozenset(re.findall(r'\w+', ''.join(changes[1])))
+      self.lock.acquire()
+      try:
+        self.pending -= 1
+        if stamp is not None:
+          self.indexed.append(names)
+        if words is None:
+          continue
+        self.remove(names)
+        for word in words:
+          if word not in self.words:
+            self.addWord(word)
+          self.words[word].add(names)
+          for part, found in self.found.iteritems():
+            if part in word:
+              found.add(names)
+        self.pair_words[names] = words
+        self.stamps[names] = stamp
+      finally:
+        self.lock.release()
+    return len(items)
+
+  def done(self, count):
+    # Forgets count pairs that were submitted but will not be indexed.
+    self.lock.acquire()
+    try:
+      self.pending -= count
+    finally:
+      self.lock.release()
+
+  def takeIndexed(self):
+    self.lock.acquire()
+    try:
+      indexed, self.indexed = self.indexed, []
+    finally:
+      self.lock.release()
+    return indexed
+
+  def addWord(self, word):
+    # Callers hold the lock.
+    self.words[word] = set()
+    if len(word) < 3:
+      self.short_words.add(word)
+    trigrams = self.trigrams
+    for i in xrange(len(word) - 2):
+      trigram = word[i:i + 3]
+      if trigram in trigrams:
+        trigrams[trigram].add(word)
+      else:
+        trigrams[trigram] = set([word])
+
+  def remove(self, names):
+    # Callers hold the lock.
+    words = self.pair_words.pop(names, ())
+    if words:
+      self.found = {}
+    for word in words:
+      self.words[word].discard(names)
+      if not self.words[word]:
+        del self.words[word]
+        self.short_words.discard(word)
+        for i in xrange(len(word) - 2):
+          trigram = self.trigrams[word[i:i + 3]]
+          trigram.discard(word)
+          if not trigram:
+            del self.trigrams[word[i:i + 3]]
+    self.stamps.pop(names, None)
+
+  def getWords(self, part):
+    # Callers hold the lock.  Returns the words containing part: longer parts
+    # narrow the words down to those having all its trigrams, shorter ones
+    # take the words of the trigrams containing them.
+    if len(part) < 3:
+      words = set(word for word in self.short_words if part in word)
+      for trigram, trigram_words in self.trigrams.iteritems():
+        if part in trigram:
+          words.update(trigram_words)
+      return words
+    candidates = sorted([self.trigrams.get(part[i:i + 3], ())
+                         for i in xrange(len(part) - 2)], key=len)
+    return [word for word in candidates[0] if part in word]
+
+  def discard(self, names_list):
+    self.lock.acquire()
+    try:
+      for names in names_list:
+        self.remove(names)
+    finally:
+      self.lock.release()
+
+  def find(self, term):
+    # Returns the names of the pairs with, for every word in term, a changed
+    # word containing it.
+    import re
+    found = set()
+    self.lock.acquire()
+    try:
+      for i, part in enumerate(re.findall(r'\w+', term)):
+        names = self.found.get(part)
+        if names is None:
+          names = set()
+          for word in self.getWords(part):
+            names.update(self.words[word])
+          if len(self.found) >= self.max_found:
+            self.found = {}
+          self.found[part] = names
+        if i == 0:
+          found = set(names)
+        else:
+          found &= names
+        if not found:
+          break
+    finally:
+      self.lock.release()
+    return found
+
 #------------------------------ gui ------------------------------
 
-def startGui(scm, xd_dir, cmdline, env, display_cmdline):
+def startGui(scm, xd_dir, cmdline, env, display_cmdline, job):
 
-  import difflib
+  import time
   importStar('Tkinter', READONLY='readonly')
   importStar('tkFont')
 
@@ -358,6 +2388,28 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
     def __init__(self):
       Tk.__init__(self)
       self.title('xd: ' + abbrPath(os.getcwd()))
+      self.job = job
+      self.preview_worker = PreviewWorker()
+      self.preview_cache = PreviewCache(
+          int(os.environ.get(XD_PREVIEW_CACHE_ENV, 64)) * 1024 * 1024)
+      self.preview_job = None
+      self.prefetch_jobs = {}
+      self.render_id = None
+      self.highlight_id = None
+      self.preview_results = None
+      self.search_index = SearchIndex()
+      self.filter_id = None
+      self.stats_id = None
+      self.pair_keys = {}
+      self.pair_stats = {}
+      self.stat_totals = [0, 0]
+      self.stat_names = []
+      self.row_numbers = {}
+      self.labelled = set()
+      self.tools = ToolManager(int(os.environ.get(XD_MAX_TOOLS_ENV, 4)))
+      self.tools_id = None
+      self.marked = set()
+      self.prefetch = int(os.environ.get(XD_PREFETCH_ENV, 2))
       self.initFonts()
       self.initWidgets()
       self.initContents()
@@ -389,26 +2441,48 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
 
       def initPanedWindow(parent):
 
+        def initFilterFrame(parent):
+          f = Frame(parent)
+          l = Label(f, text='Filter: ')
+          sv = StringVar()
+          e = Entry(f, font=self.command_font, bg='white', textvariable=sv)
+          e.bind('<Return>', lambda _: self.file_listbox.focus())
+          e.bind('<Escape>', lambda _: sv.set(''))
+          sl = Label(f)
+          sv.trace('w', lambda *_: self.scheduleFilter())
+          bv = BooleanVar()
+          c = Checkbutton(f, text='Largest first', variable=bv)
+          bv.trace('w', lambda *_: self.scheduleFilter())
+
+          l.grid(row=0, column=0)
+          e.grid(row=0, column=1, sticky=EW)
+          sl.grid(row=0, column=2)
+          c.grid(row=0, column=3)
+          f.columnconfigure(1, weight=1)
+
+          self.filter_stringvar = sv
+          self.filter_label = sl
+          self.sort_booleanvar = bv
+          return f
+
         def initFileListFrame(parent):
           lf = LabelFrame(parent, labelanchor=N, text='0 pairs of files')
-          l = Listbox(lf, selectmode=SINGLE, bg='white', exportselection=0,
+          ff = initFilterFrame(lf)
+          l = Listbox(lf, selectmode=EXTENDED, bg='white', exportselection=0,
                       font=self.fixed_bold_font)
           s = Scrollbar(lf, orient=VERTICAL, takefocus=False, command=l.yview)
           l.config(yscrollcommand=s.set)
           l.bind('<Button-1>', lambda _: l.focus())
-          l.bind('<Return>',
-                 lambda _: (l.select_clear(0, END),
-                            l.select_set(ACTIVE),
-                            l.event_generate('<<ListboxSelect>>'),
-                            self.launchDiffTool(l.index(ACTIVE))))
+          l.bind('<Return>', lambda _: self.launchSelected())
           l.bind('<<ListboxSelect>>', self.previewDiff)
           l.bind('<Double-Button-1>',
                  lambda e: self.launchDiffTool(l.nearest(e.y)))
 
-          l.grid(row=0, column=0, sticky=EW + NS)
-          s.grid(row=0, column=1, sticky=NS)
+          ff.grid(row=0, column=0, columnspan=2, sticky=EW)
+          l.grid(row=1, column=0, sticky=EW + NS)
+          s.grid(row=1, column=1, sticky=NS)
           lf.columnconfigure(0, weight=1)
-          lf.rowconfigure(0, weight=1)
+          lf.rowconfigure(1, weight=1)
 
           self.file_listbox_labelframe = lf
           self.file_listbox = l
@@ -421,8 +2495,11 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
           t.tag_config('hunk', foreground='blue')
           t.tag_config('add', foreground='forestgreen')
           t.tag_config('del', foreground='red')
+          t.tag_config('add_word', background='#c8f0c8')
+          t.tag_config('del_word', background='#f8c8c8')
           s = Scrollbar(f, orient=VERTICAL, takefocus=False, command=t.yview)
-          t.config(yscrollcommand=s.set)
+          t.config(yscrollcommand=lambda first, last: s.set(first, last) or
+                   self.scheduleHighlight())
           t.bind('<Key>', lambda e: e.char and 'break')
           t.bind('<Return>', lambda e: self.launchDiffTool(e) or 'break')
 
@@ -450,9 +2527,11 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
           e.bind('<FocusIn>',
                  lambda _: iv.get() != len(rs) and iv.set(len(rs)))
           e.bind('<Return>', self.launchDiffTool)
+          b = Button(f, text='Launch selected', command=self.launchSelected)
 
           r.grid(row=0, column=0)
           e.grid(row=0, column=1, sticky=EW)
+          b.grid(row=0, column=2)
           f.columnconfigure(1, weight=1)
 
           self.custom_diff_stringvar = sv
@@ -487,6 +2566,7 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
           lf.columnconfigure(i, weight=1)
 
         self.diff_intvar = iv
+        self.diff_tool_labelframe = lf
 
         d = None
         xd_diff = os.environ.get(XD_DIFF_ENV)
@@ -521,29 +2601,350 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
       self.rowconfigure(1, weight=1)
 
     def initContents(self):
-      files_path = os.path.join(xd_dir, 'FILES')
-      if os.path.isfile(files_path):
-        self.files = cPickle.load(open(files_path))
-      else:
-        self.files = []
-      self.file_listbox_labelframe.config(text='%s pair%s of files' % (
-          len(self.files), len(self.files) != 1 and 's' or ''))
       self.file_listbox.insert(END, 'STDOUT')
       self.file_listbox.itemconfig(0, fg='blue', selectforeground='blue')
-      for pair in self.files:
-        self.file_listbox.insert(END, pair['path'])
+      self.files = []
+      self.rows = []
+      self.new_files = None
+      self.files_status = ''
+      self.manifest = self.job.manifest
+      self.stdout_size = 0
+      self.preview_key = None
+      self.loadFiles()
       self.file_listbox.select_set(0)
       self.previewDiff(0)
       self.file_listbox.focus()
 
+    def loadFiles(self):
+      returncode = self.job.poll()
+      pairs = list(self.manifest.read())
+      items = []
+      for pair in pairs:
+        names = (pair['xd_dir_path1'], pair['xd_dir_path2'])
+        self.pair_keys[names] = self.getPreviewKey(pair)
+        self.dropStat(names)
+        items.append((names, self.pair_keys[names]))
+      self.search_index.submit(self.preview_worker, self.preview_cache, items)
+      if pairs and self.stats_id is None:
+        self.stats_id = self.after(300, self.refreshStats)
+      if self.new_files is None:
+        match = self.getFilter()
+        texts = []
+        for pair in pairs:
+          if match is None or match(pair):
+            self.rows.append(len(self.files))
+            self.row_numbers[pair['xd_dir_path1'],
+                             pair['xd_dir_path2']] = len(self.rows)
+            texts.append(self.getRowText(pair))
+          self.files.append(pair)
+        if texts:
+          self.file_listbox.insert(END, *texts)
+        if pairs and (match is not None or self.sort_booleanvar.get()) and (
+            self.filter_id is None):
+          self.scheduleFilter()
+      else:
+        self.new_files.extend(pairs)
+        if returncode is not None:
+          self.updateFiles()
+      if returncode is None:
+        self.files_status = ' (collecting, %ds)' % (
+            time.time() - self.job.start_time)
+        self.load_files_id = self.after(200, self.loadFiles)
+      else:
+        self.files_status = ''
+        self.load_files_id = None
+        if returncode != 0:
+          self.files_status = ' (%s exited with %s)' % (cmdline[0], returncode)
+      self.updateHeader()
+
+      stdout_size = os.path.getsize(os.path.join(xd_dir, 'STDOUT'))
+      if stdout_size != self.stdout_size:
+        self.stdout_size = stdout_size
+        if self.getFileIndex(None) == 0:
+          self.previewDiff(0)
+
     def reRunCommand(self):
-      shutil.rmtree(xd_dir)
-      os.mkdir(xd_dir)
-      returncode = runScmDiff(cmdline, env, xd_dir)
-      if returncode:
-        sys.exit(returncode)
-      self.file_listbox.delete(0, END)
-      self.initContents()
+      if self.load_files_id is not None:
+        self.after_cancel(self.load_files_id)
+      self.job.kill()
+      if self.new_files is not None:
+        self.removeFiles(self.new_files, self.files)
+      previous = {}
+      for parsed in self.files:
+        previous[scm.getPairId(parsed)] = parsed
+      previous.pop(None, None)
+      for name in ('FILES', 'STDOUT', 'CMDLINE', 'ARGS'):
+        path = os.path.join(xd_dir, name)
+        if os.path.exists(path):
+          os.remove(path)
+      self.job = ScmDiffJob(*self.job.args + (previous,))
+      self.new_files = []
+      self.manifest = self.job.manifest
+      self.stdout_size = -1
+      self.loadFiles()
+
+    def updateFiles(self):
+      self.removeFiles(self.files, self.new_files)
+      files = self.new_files
+      self.new_files = None
+      self.showRows(files, self.getRows(files, self.getFilter()))
+
+    def showRows(self, files, rows):
+      # Turns the listbox rows into the given rows of files with as few
+      # listbox changes as possible and keeps every selected row on its path.
+      # Rows whose path is gone are unselected, and if none is left the row
+      # now in place of the previewed one is selected.
+      import bisect
+      old_paths = [self.files[i]['path'] for i in self.rows]
+      new_paths = [files[i]['path'] for i in rows]
+      opcodes = getOpcodes(FastEngine.getMatchingBlocks(old_paths, new_paths))
+      selected = self.getFileIndex(None)
+      selection = self.getSelectedRows()
+      new_selection = dict((row, row) for row in selection)
+      new_rows = None
+      fallback = selected
+      for tag, i1, i2, j1, j2 in reversed(opcodes):
+        moved = selection[bisect.bisect_right(selection, i1):
+                          bisect.bisect_right(selection, i2)]
+        if tag == 'equal':
+          for row in moved:
+            new_selection[row] = row - i1 + j1
+          continue
+        if i1 < i2:
+          self.file_listbox.delete(i1 + 1, i2)
+        if j1 < j2:
+          self.file_listbox.insert(i1 + 1, *[self.getRowText(files[i])
+                                             for i in rows[j1:j2]])
+        if moved and new_rows is None:
+          new_rows = dict((path, row + 1) for row, path in
+                          enumerate(new_paths))
+        for row in moved:
+          if old_paths[row - 1] in new_rows:
+            new_selection[row] = new_rows[old_paths[row - 1]]
+          else:
+            if row == selected:
+              fallback = min(row - i1 + j1, j2)
+            del new_selection[row]
+      self.files = files
+      self.rows = rows
+      self.row_numbers = dict(
+          ((files[i]['xd_dir_path1'], files[i]['xd_dir_path2']), row + 1)
+          for row, i in enumerate(rows))
+      self.markRows()
+      if selected is not None:
+        if selected in new_selection:
+          new_selected = new_selection[selected]
+        elif new_selection:
+          new_selected = min(new_selection.values())
+        else:
+          new_selected = new_selection[selected] = fallback
+        self.file_listbox.select_clear(0, END)
+        for row in sorted(set(new_selection.values())):
+          self.file_listbox.select_set(row)
+        self.file_listbox.see(new_selected)
+        if new_selected == 0:
+          if selected != 0:
+            self.previewDiff(0)
+        elif (self.getPreviewKey(self.getPair(new_selected)) !=
+              self.preview_key):
+          self.previewDiff(new_selected)
+
+    def removeFiles(self, files, keep):
+      kept = set()
+      for parsed in keep:
+        kept.update((parsed['xd_dir_path1'], parsed['xd_dir_path2']))
+      removed = []
+      for parsed in files:
+        names = (parsed['xd_dir_path1'], parsed['xd_dir_path2'])
+        for path in names:
+          if path not in kept and os.path.lexists(path):
+            os.remove(path)
+        if names[0] not in kept or names[1] not in kept:
+          removed.append(names)
+          self.pair_keys.pop(names, None)
+          self.dropStat(names)
+          self.labelled.discard(names)
+      self.search_index.discard(removed)
+
+    def getPair(self, index):
+      return self.files[self.rows[index - 1]]
+
+    def getFilter(self):
+      # Returns a predicate for the pairs matching every term of the filter
+      # box, or None without terms.  Terms with glob characters match the
+      # path, others a part of the path or words of the changed lines.
+      import fnmatch
+      tests = []
+      for term in self.filter_stringvar.get().split():
+        if '*' in term or '?' in term or '[' in term:
+          tests.append((term, None))
+        else:
+          tests.append((term, self.search_index.find(term)))
+      if not tests:
+        return None
+
+      def match(parsed):
+        path = parsed['path']
+        for term, found in tests:
+          if found is None:
+            if not fnmatch.fnmatch(path, term):
+              return False
+          elif term not in path and (
+              parsed['xd_dir_path1'], parsed['xd_dir_path2']) not in found:
+            return False
+        return True
+
+      return match
+
+    def scheduleFilter(self):
+      if self.filter_id is not None:
+        self.after_cancel(self.filter_id)
+      self.filter_id = self.after_idle(self.filterFiles)
+
+    def getRows(self, files, match):
+      # Returns the indexes in files of the pairs match lets through, the
+      # most changed lines first if asked to, then pairs not diffed, then
+      # pairs not diffed yet.
+      rows = [i for i, parsed in enumerate(files)
+              if match is None or match(parsed)]
+      if self.sort_booleanvar.get():
+
+        def getSize(i):
+          stat = self.getStat(files[i])
+          if stat is None:
+            return 1
+          if stat[0] is not None:
+            return 0
+          return -stat[1] - stat[2]
+
+        rows.sort(key=getSize)
+      return rows
+
+    def filterFiles(self):
+      # Shows the pairs matching the filter box in the chosen order, again
+      # every half second while the search index is still being built.
+      self.filter_id = None
+      match = self.getFilter()
+      rows = self.getRows(self.files, match)
+      if match is None:
+        self.filter_label.config(text='')
+      else:
+        text = '%d of %d' % (len(rows), len(self.files))
+        if self.search_index.pending:
+          text += ' (indexing %d)' % self.search_index.pending
+        self.filter_label.config(text=text)
+      if self.search_index.pending and (
+          self.filter_stringvar.get().strip() or self.sort_booleanvar.get()):
+        self.filter_id = self.after(500, self.filterFiles)
+      self.showRows(self.files, rows)
+
+    def getStat(self, parsed):
+      names = (parsed['xd_dir_path1'], parsed['xd_dir_path2'])
+      stat = self.pair_stats.get(names)
+      if stat is None:
+        key = self.pair_keys.get(names) or self.getPreviewKey(parsed)
+        stat = self.preview_cache.getStat(key)
+        if stat is not None:
+          self.setStat(names, stat)
+      return stat
+
+    def setStat(self, names, stat):
+      # Remembers the diffstat of a pair and keeps the totals of the header
+      # up to date without going over all pairs.
+      self.dropStat(names)
+      self.pair_stats[names] = stat
+      self.stat_totals[0] += stat[1]
+      self.stat_totals[1] += stat[2]
+
+    def dropStat(self, names):
+      stat = self.pair_stats.pop(names, None)
+      if stat is not None:
+        self.stat_totals[0] -= stat[1]
+        self.stat_totals[1] -= stat[2]
+
+    def getRowText(self, parsed):
+      # Puts the diffstat of a pair before its path and remembers if it was
+      # known yet.
+      names = (parsed['xd_dir_path1'], parsed['xd_dir_path2'])
+      stat = self.getStat(parsed)
+      if stat is None:
+        self.labelled.discard(names)
+        column = ''
+      else:
+        self.labelled.add(names)
+        column = stat[0] or '+%d -%d' % (stat[2], stat[1])
+      return '%-13s %s' % (column, parsed['path'])
+
+    def refreshStats(self):
+      # Shows the diffstats computed in the background since the last call,
+      # every 300ms until the search index is done.  Pairs of a rerun that
+      # are not in the list yet wait for the next call.
+      self.stats_id = None
+      selected = self.getSelectedRows()
+      names_list = self.stat_names + self.search_index.takeIndexed()
+      self.stat_names = []
+      updates = []
+      for names in names_list:
+        key = self.pair_keys.get(names)
+        stat = key and self.preview_cache.getStat(key)
+        if stat is None:
+          continue
+        if self.pair_stats.get(names) != stat:
+          self.setStat(names, stat)
+        row = self.row_numbers.get(names)
+        if row is None:
+          if self.new_files is not None:
+            self.stat_names.append(names)
+        elif names not in self.labelled:
+          updates.append((row, self.getRowText(self.getPair(row))))
+      updates.sort()
+      k = 0
+      while k < len(updates):
+        first = updates[k][0]
+        end = k + 1
+        while end < len(updates) and updates[end][0] == first + end - k:
+          end += 1
+        self.file_listbox.delete(first, first + end - k - 1)
+        self.file_listbox.insert(first, *[text for _, text in updates[k:end]])
+        for row in selected:
+          if first <= row < first + end - k:
+            self.file_listbox.select_set(row)
+        k = end
+      if updates:
+        self.markRows()
+      self.updateHeader()
+      if self.search_index.pending or self.stat_names:
+        self.stats_id = self.after(300, self.refreshStats)
+
+    def refreshRow(self, row):
+      # Shows the diffstat of one row once known, as after its preview.
+      if not 1 <= row <= len(self.rows):
+        return
+      parsed = self.getPair(row)
+      names = (parsed['xd_dir_path1'], parsed['xd_dir_path2'])
+      if names in self.labelled or self.getStat(parsed) is None:
+        return
+      selected = self.getSelectedRows()
+      self.file_listbox.delete(row)
+      self.file_listbox.insert(row, self.getRowText(parsed))
+      if row in selected:
+        self.file_listbox.select_set(row)
+      self.markRows()
+      self.updateHeader()
+
+    def updateHeader(self):
+      if self.new_files is None:
+        files = self.files
+      else:
+        files = self.new_files
+      text = '%s pair%s of files' % (len(files), len(files) != 1 and 's' or '')
+      removed, added = self.stat_totals
+      if added or removed:
+        text += ', +%d -%d' % (added, removed)
+      self.file_listbox_labelframe.config(text=text + self.files_status)
+
+    def getSelectedRows(self):
+      return [int(row) for row in self.file_listbox.curselection()]
 
     def getFileIndex(self, event_or_index):
       if isinstance(event_or_index, (int, long)):
@@ -560,14 +2961,22 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
       selected = self.getFileIndex(event_or_index)
       if selected is None:
         return
-
+      start = traceStart()
+
+      if self.preview_job is not None:
+        self.preview_job.cancel()
+        self.preview_job = None
+      if self.render_id is not None:
+        self.after_cancel(self.render_id)
+        self.render_id = None
+      self.preview_results = None
       self.preview_text.delete(1.0, END)
       if selected == 0:
         stdout = os.path.join(xd_dir, 'STDOUT')
         self.preview_text.insert(END, 'PATH: %s\n' % stdout, 'meta')
         self.preview_text.insert(END, open(stdout).read())
       else:
-        parsed = self.files[selected - 1]
+        parsed = self.getPair(selected)
         for key in ('path', 'rev', 'mode', 'hash'):
           key1 = key + '1'
           key2 = key + '2'
@@ -582,41 +2991,231 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
                                         key2.upper(), parsed[key2]),
                   'meta')
 
-        size1 = os.path.getsize(parsed['xd_dir_path1'])
-        size2 = os.path.getsize(parsed['xd_dir_path2'])
-        MAX_SIZE = 4 * 1024 * 1024
-        if size1 > MAX_SIZE or size2 > MAX_SIZE:
-          results = [' Files are too big (>%d) to diff\n' % MAX_SIZE,
-                     '-file size 1: %d\n' % size1,
-                     '+file size 2: %d\n' % size2]
+        self.preview_start = self.preview_text.index('end - 1c')
+        key = self.getPreviewKey(parsed)
+        self.preview_key = key
+        results = self.preview_cache.get(key)
+        if results is not None:
+          self.renderPreview(results)
+          self.after_idle(self.prefetchPreviews, selected)
+        elif key in self.prefetch_jobs:
+          self.preview_job = self.prefetch_jobs.pop(key)
+          self.preview_worker.promote(self.preview_job)
+          self.after(10, self.showPreview, self.preview_job, selected)
         else:
-          lines1 = open(parsed['xd_dir_path1']).readlines()
-          lines2 = open(parsed['xd_dir_path2']).readlines()
-          max_len1 = lines1 and max(len(line) for line in lines1) or 0
-          max_len2 = lines2 and max(len(line) for line in lines2) or 0
-          MAX_LINE_LEN = 1024
-          if max_len1 > MAX_LINE_LEN or max_len2 > MAX_LINE_LEN:
-            results = [' Lines are too long (>%d) to diff\n' % MAX_LINE_LEN,
-                       '-max line length 1: %d\n' % max_len1,
-                       '+max line length 2: %d\n' % max_len2]
-          elif not isText(lines1) or not isText(lines2):
-            results = [' Binary files diff\n']
-          else:
-            results = (line
-                       for i, line in enumerate(difflib.unified_diff(
-                          lines1, lines2))
-                       if i >= 2)
+          self.preview_job = self.preview_worker.submit(self.diffPair, key,
+                                                        parsed)
+          self.after(10, self.showPreview, self.preview_job, selected)
+      self.preview_time = start
+      traceSpan('preview', start, index=selected)
+
+    def getPreviewKey(self, parsed):
+      return (scm.getContentId(parsed, 1), scm.getContentId(parsed, 2))
+
+    def diffPair(self, key, parsed, job=None):
+      # Runs in the preview worker.  Sides that were left out by XD_LAZY are
+      # fetched first, after which the pair can be indexed as well.
+      names = (parsed['xd_dir_path1'], parsed['xd_dir_path2'])
+      fetched = scm.fetchLazy(parsed)
+      results = self.preview_cache.diff(key, names[0], names[1], job)
+      if fetched:
+        self.search_index.submit(self.preview_worker, self.preview_cache,
+                                 [(names, key)])
+      return results
+
+    def showPreview(self, job, selected):
+      if job is not self.preview_job:
+        return
+      if not job.done:
+        if self.preview_text.index('end - 1c') == self.preview_start:
+          self.preview_text.insert(END, ' Computing diff...\n', 'meta')
+        self.after(50, self.showPreview, job, selected)
+        return
+      self.preview_job = None
+      traceSpan('preview latency', self.preview_time, index=selected)
+      self.preview_text.delete(self.preview_start, END)
+      if job.error:
+        self.preview_text.insert(END, job.error)
+        return
+      self.renderPreview(job.result)
+      self.refreshRow(selected)
+      self.after_idle(self.prefetchPreviews, selected)
 
-        tags = {'-': 'del', '+': 'add', '@': 'hunk'}
-        for i, line in enumerate(results):
-          tag = tags.get(line[0])
-          self.preview_text.insert(END, line, tag)
+    def prefetchPreviews(self, selected):
+      if selected != self.getFileIndex(None):
+        return
+      indexes = range(selected + 1, selected + self.prefetch + 1)
+      if self.prefetch:
+        indexes.append(selected - 1)
+      jobs = {}
+      for index in indexes:
+        if not 1 <= index <= len(self.rows):
+          continue
+        parsed = self.getPair(index)
+        key = self.getPreviewKey(parsed)
+        if None in key or key in self.preview_cache:
+          continue
+        job = self.prefetch_jobs.get(key)
+        if job is None:
+          too_big = False
+          for path in (parsed['xd_dir_path1'], parsed['xd_dir_path2']):
+            if os.path.exists(path):
+              too_big = too_big or os.path.getsize(path) > MAX_PREFETCH_SIZE
+          if too_big:
+            continue
+          job = self.preview_worker.submitPrefetch(self.diffPair, key, parsed)
+        jobs[key] = job
+      for key, job in self.prefetch_jobs.iteritems():
+        if key not in jobs:
+          job.cancel()
+      self.prefetch_jobs = jobs
+
+    def renderPreview(self, results, start=0):
+      trace_start = traceStart()
+      self.render_id = None
+      if start == 0:
+        self.preview_results = results
+        self.preview_blocks = None
+        self.preview_highlighted = set()
+      tags = {'-': 'del', '+': 'add', '@': 'hunk'}
+      end = min(len(results), start + RENDER_SLICE)
+      args = []
+      chunk = []
+      tag = ''
+      for i in xrange(start, end):
+        line = results[i]
+        line_tag = tags.get(line[:1], '')
+        if line_tag != tag and chunk:
+          args.extend((''.join(chunk), tag))
+          chunk = []
+        tag = line_tag
+        chunk.append(line[-1:] == '\n' and line or line + '\n')
+      if chunk:
+        args.extend((''.join(chunk), tag))
+      if args:
+        self.preview_text.insert(END, *args)
+      traceSpan('render', trace_start, lines=end - start)
+      if end < len(results):
+        self.render_id = self.after_idle(self.renderPreview, results, end)
+
+    def scheduleHighlight(self):
+      if self.highlight_id is None:
+        self.highlight_id = self.after_idle(self.highlightPreview)
+
+    def highlightPreview(self):
+      # Marks the words that differ between paired '-' and '+' lines, only for
+      # the pairs on screen; each pair is done once per preview.
+      import bisect
+      self.highlight_id = None
+      results = self.preview_results
+      if results is None:
+        return
+      trace_start = traceStart()
+      if self.preview_blocks is None:
+        self.preview_blocks = getChangeBlocks(results)
+      t = self.preview_text
+      first = int(self.preview_start.split('.')[0])
+      top = int(t.index('@0,0').split('.')[0]) - first
+      bottom = int(t.index('@0,%d' % t.winfo_height()).split('.')[0]) - first
+
+      def decode(line):
+        try:
+          return line[1:].rstrip('\n').decode('utf-8')
+        except UnicodeDecodeError:
+          return line[1:].rstrip('\n').decode('latin-1')
+
+      ranges = {'del_word': [], 'add_word': []}
+      blocks = self.preview_blocks
+      done = self.preview_highlighted
+      for i in xrange(max(0, bisect.bisect(blocks, (top + 1,)) - 1),
+                      len(blocks)):
+        start, deleted, added = blocks[i]
+        if start > bottom:
+          break
+        pairs = min(deleted, added)
+        for lo, hi in ((top - start, bottom - start + 1),
+                       (top - start - deleted, bottom - start - deleted + 1)):
+          for k in xrange(max(0, lo), min(pairs, hi)):
+            index1 = start + k
+            index2 = start + deleted + k
+            if index1 in done:
+              continue
+            done.add(index1)
+            pair = getIntralineRanges(decode(results[index1]),
+                                      decode(results[index2]))
+            if pair is None:
+              continue
+            for tag, index, line_ranges in (('del_word', index1, pair[0]),
+                                            ('add_word', index2, pair[1])):
+              line = first + index
+              for range_start, range_end in line_ranges:
+                ranges[tag].extend(('%d.%d' % (line, 1 + range_start),
+                                    '%d.%d' % (line, 1 + range_end)))
+      for tag, indexes in ranges.iteritems():
+        if indexes:
+          t.tag_add(tag, *indexes)
+      traceSpan('intraline', trace_start, pairs=len(done))
 
     def launchDiffTool(self, event_or_index):
       selected = self.getFileIndex(event_or_index)
       if selected is not None and selected > 0:
-        DiffTool.launchCustom(self.custom_diff_stringvar.get(),
-                              self.files[selected - 1])
+        self.launchRows([selected])
+
+    def launchSelected(self):
+      rows = [row for row in self.getSelectedRows() if row > 0]
+      if not rows and self.file_listbox.index(ACTIVE) > 0:
+        rows = [self.file_listbox.index(ACTIVE)]
+      self.launchRows(rows)
+
+    def launchRows(self, rows):
+      # Hands the pairs to the ToolManager with the diff tool chosen now;
+      # pairs left out by XD_LAZY are fetched once their tool starts.
+      iv = self.diff_intvar.get()
+      tool = iv < len(DiffTool.all) and DiffTool.all[iv] or None
+      command = self.custom_diff_stringvar.get()
+
+      def launch(parsed):
+        scm.fetchLazy(parsed)
+        if tool is not None:
+          return tool.launch(parsed)
+        return DiffTool.launchCustom(command, parsed)
+
+      for row in rows:
+        parsed = self.getPair(row)
+        self.tools.submit((parsed['xd_dir_path1'], parsed['xd_dir_path2']),
+                          lambda parsed=parsed: launch(parsed))
+      self.showTools()
+
+    def reapTools(self):
+      # Waits for the diff tools that exited, every half second while any
+      # is open or queued.
+      self.tools_id = None
+      if self.tools.reap():
+        self.showTools()
+      elif self.tools.running or self.tools.queued:
+        self.tools_id = self.after(500, self.reapTools)
+
+    def showTools(self):
+      text = 'Diff Tool (double click to launch)'
+      if self.tools.running:
+        text += ', %d open' % len(self.tools.running)
+      if self.tools.queued:
+        text += ', %d queued' % len(self.tools.queued)
+      self.diff_tool_labelframe.config(text=text)
+      self.markRows()
+      if self.tools_id is None and (self.tools.running or self.tools.queued):
+        self.tools_id = self.after(500, self.reapTools)
+
+    def markRows(self):
+      # Highlights the rows of the pairs whose diff tool is open.  Rows that
+      # were replaced lost their highlight, so all open ones are marked again.
+      open_names = self.tools.getOpen()
+      for names in self.marked | open_names:
+        row = self.row_numbers.get(names)
+        if row is not None:
+          self.file_listbox.itemconfig(
+              row, background=names in open_names and '#ffffc0' or '')
+      self.marked = open_names
 
     def selectDiffTool(self, *_):
       iv = self.diff_intvar.get()
@@ -626,22 +3225,379 @@ def startGui(scm, xd_dir, cmdline, env, display_cmdline):
       else:
         self.custom_diff_entry.config(state=READONLY)
         self.custom_diff_stringvar.set(DiffTool.all[iv].command)
+        DiffTool.all[iv].warm()
 
-  App().mainloop()
+  app = App()
+  try:
+    app.mainloop()
+  finally:
+    app.preview_worker.stop()
+    # Rerun replaces the job, so the caller has to kill the last one.
+    app.job.kill()
+
+#------------------------------ batch ------------------------------
+
+def batchDiff(item):
+  # Diffs the pair of an (index, parsed) item from runBatch.
+  import time
+  start = time.time()
+  index, parsed = item
+  path1, path2 = parsed['xd_dir_path1'], parsed['xd_dir_path2']
+  summary = {'index': index, 'path': parsed['path'], 'path1': parsed['path1'],
+             'path2': parsed['path2']}
+  for key in ('rev1', 'rev2', 'hash1', 'hash2', 'mode1', 'mode2'):
+    if key in parsed:
+      summary[key] = parsed[key]
+  patch = []
+  try:
+    summary['size1'] = os.path.getsize(path1)
+    summary['size2'] = os.path.getsize(path2)
+    header = getPatchHeader(parsed)
+    engine = getDiffEngine()
+    check = checkFiles(path1, path2, engine)
+    if check is not None:
+      # Files not diffed as text go in whole, as git does with --binary.
+      summary['kind'] = check[0]
+      patch.extend(header)
+      patch.append('index %s..%s\n' % (getGitHash(path1), getGitHash(path2)))
+      patch.append(getBinaryPatch(path1, path2))
+    else:
+      lines1 = open(path1).readlines()
+      lines2 = open(path2).readlines()
+      blocks = engine.getMatchingBlocks(lines1, lines2)
+      summary['kind'] = 'text'
+      summary['added'] = summary['removed'] = 0
+      if len(header) > 1:
+        patch.extend(header)
+      for line in unifiedDiff(lines1, lines2, blocks):
+        if not patch:
+          patch.extend(header)
+        if len(patch) == len(header):
+          for i, sign, prefix in ((1, '---', 'a/'), (2, '+++', 'b/')):
+            if isMissing(parsed, i):
+              patch.append('%s /dev/null\n' % sign)
+            else:
+              # Like git, end names with spaces with a tab for GNU patch.
+              path = parsed['path%s' % i]
+              patch.append('%s %s%s\n' % (sign, quoteGitPath(path, prefix),
+                                          ' ' in path and '\t' or ''))
+        if line[0] == '+':
+          summary['added'] += 1
+        elif line[0] == '-':
+          summary['removed'] += 1
+        patch.append(line)
+        if not line.endswith('\n'):
+          patch.append('\n\\ No newline at end of file\n')
+  except (IOError, OSError), e:
+    summary['kind'] = 'error'
+    summary['error'] = str(e)
+  summary['seconds'] = round(time.time() - start, 6)
+  return summary, ''.join(patch)
+
+
+def isMissing(parsed, i):
+  return (parsed.get('hash%s' % i) == '.' or
+          parsed.get('revision%s' % i) == '(nonexistent)')
+
+
+def getPatchHeader(parsed):
+  # Returns the lines of the git style header of a pair in the patch, which
+  # 'git apply' takes: a/ and b/ paths quoted as git does and the file modes,
+  # 100644 where the SCM has none.
+  modes = []
+  for i in (1, 2):
+    mode = parsed.get('mode%s' % i)
+    modes.append(mode not in (None, '.') and mode or '100644')
+  header = ['diff --git %s %s\n' % (quoteGitPath(parsed['path1'], 'a/'),
+                                     quoteGitPath(parsed['path2'], 'b/'))]
+  if isMissing(parsed, 1):
+    header.append('new file mode %s\n' % modes[1])
+  elif isMissing(parsed, 2):
+    header.append('deleted file mode %s\n' % modes[0])
+  else:
+    if modes[0] != modes[1]:
+      header.append('old mode %s\nnew mode %s\n' % tuple(modes))
+    if parsed['path1'] != parsed['path2']:
+      how = parsed.get('status') == 'C' and 'copy' or 'rename'
+      header.append('%s from %s\n%s to %s\n' % (
+          how, quoteGitPath(parsed['path1']), how,
+          quoteGitPath(parsed['path2'])))
+  return header
+
+
+GIT_ESCAPES = {'\a': 'a', '\b': 'b', '\t': 't', '\n': 'n', '\v': 'v',
+               '\f': 'f', '\r': 'r', '"': '"', '\\': '\\'}
+
+def quoteGitPath(path, prefix=''):
+  # Returns prefix + path as git writes it in patches: in double quotes with
+  # C escapes when it has quotes, backslashes, control or non-ASCII bytes.
+  name = prefix + path
+  quoted = []
+  for c in name:
+    if c in GIT_ESCAPES:
+      quoted.append('\\' + GIT_ESCAPES[c])
+    elif ' ' <= c < '\x7f':
+      quoted.append(c)
+    else:
+      quoted.append('\\%03o' % ord(c))
+  quoted = ''.join(quoted)
+  if quoted == name:
+    return name
+  return '"%s"' % quoted
+
+
+def getGitHash(path):
+  import hashlib
+  data = open(path, 'rb').read()
+  return hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+
+
+BASE85 = ('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+          '!#$%&()*+-;<=>?@^_`{|}~')
+
+def getBinaryPatch(path1, path2):
+  # Returns a 'GIT binary patch' with the deflated contents of path2, and of
+  # path1 to reverse it, in git's base85 lines of up to 52 bytes.
+  import struct
+  import zlib
+  hunks = ['GIT binary patch\n']
+  for path in (path2, path1):
+    data = open(path, 'rb').read()
+    hunks.append('literal %d\n' % len(data))
+    deflated = zlib.compress(data)
+    for i in xrange(0, len(deflated), 52):
+      chunk = deflated[i:i + 52]
+      if len(chunk) <= 26:
+        line = [chr(ord('A') + len(chunk) - 1)]
+      else:
+        line = [chr(ord('a') + len(chunk) - 27)]
+      chunk += '\0' * (-len(chunk) % 4)
+      for word in struct.unpack('>%dI' % (len(chunk) / 4), chunk):
+        digits = []
+        for _ in xrange(5):
+          word, digit = divmod(word, 85)
+          digits.append(BASE85[digit])
+        line.extend(reversed(digits))
+      hunks.append(''.join(line) + '\n')
+    hunks.append('\n')
+  return ''.join(hunks)
+
+
+def iterPairs(job):
+  import time
+  while True:
+    returncode = job.poll()
+    for parsed in job.manifest.read():
+      yield parsed
+    if returncode is not None:
+      return
+    time.sleep(0.05)
+
+
+def toJson(data):
+  import json
+  try:
+    return json.dumps(data, sort_keys=True)
+  except UnicodeDecodeError:
+    return json.dumps(data, sort_keys=True, encoding='latin-1')
+
+
+def runBatch(job, prefix, pool, display_cmdline):
+  # Diffs the pairs in a process pool as they are collected and streams the
+  # results, as they finish, to PREFIX.patch and PREFIX.json; the index of a
+  # pair in the summary gives its collection order.
+  import time
+  start = time.time()
+  patch = open(prefix + '.patch', 'w')
+  summary = open(prefix + '.json', 'w')
+  summary.write('{"command": %s, "pairs": [' % toJson(display_cmdline))
+  totals = {'pairs': 0, 'added': 0, 'removed': 0}
+  for result, text in pool.imap_unordered(batchDiff,
+                                          enumerate(iterPairs(job))):
+    patch.write(text)
+    summary.write('%s\n%s' % (totals['pairs'] and ',' or '', toJson(result)))
+    totals['pairs'] += 1
+    totals[result['kind']] = totals.get(result['kind'], 0) + 1
+    totals['added'] += result.get('added', 0)
+    totals['removed'] += result.get('removed', 0)
+  pool.close()
+  pool.join()
+  returncode = job.wait()
+  materialized = dict((via, {'files': count[0], 'bytes': count[1]})
+                      for via, count in Materializer.counts.items())
+  summary.write('\n], "totals": %s, "materialized": %s, "returncode": %s, '
+                '"seconds": %.3f}\n' % (toJson(totals), toJson(materialized),
+                                         returncode, time.time() - start))
+  patch.close()
+  summary.close()
+  print '%d pair%s of files, +%d -%d, written to %s.patch and %s.json' % (
+      totals['pairs'], totals['pairs'] != 1 and 's' or '', totals['added'],
+      totals['removed'], prefix, prefix)
+  return returncode
 
 #------------------------------ controller ------------------------------
 
-def runScmDiff(cmdline, env, xd_dir):
+def runScmDiff(cmdline, env, xd_dir, job=None):
+  import subprocess
+  start = traceStart()
   p = subprocess.Popen(args=cmdline,
                        env=env,
                        stdin=open(os.devnull),
                        stdout=open(os.path.join(xd_dir, 'STDOUT'), 'w'),
-                       close_fds=True)
-  p.wait()
+                       close_fds=True,
+                       preexec_fn=os.setpgrp)
+  if job is not None:
+    job.attach(p, group=True)
+  try:
+    p.wait()
+  finally:
+    if job is not None:
+      job.detach(p)
+  traceSpan('scm diff', start, cmdline=cmdline, returncode=p.returncode)
   return p.returncode
 
+def communicateJob(process, job=None):
+  # Waits for a child of job, which job.terminate() stops on cancel.
+  if job is None:
+    return process.communicate()
+  job.attach(process)
+  try:
+    return process.communicate()
+  finally:
+    job.detach(process)
+
+
+def setupChildCommand(xd_dir, xd=sys.argv[0]):
+  # External diff children only need mainExternalDiff.  When xd can be
+  # imported as a module they start through a wrapper that skips site and
+  # PYTHON* variables and loads the compiled module instead of compiling the
+  # whole script again; otherwise they run xd itself.  Symlinks such as
+  # xd -> xd.py are followed to find the module.
+  dirname, basename = os.path.split(os.path.realpath(xd))
+  module = basename[:-3]
+  if (not basename.endswith('.py') or not module or module[0].isdigit() or
+      not module.replace('_', 'a').isalnum()):
+    return xd
+  code = ('import sys; sys.path.insert(0, %r); import %s; '
+          'sys.exit(%s.main(sys.argv))' % (dirname, module, module))
+  path = os.path.join(xd_dir, 'CHILD')
+  f = open(path, 'w')
+  print >>f, '#!/bin/sh'
+  print >>f, 'exec %s -S -E -c %s "$@"' % (escapeShell(sys.executable),
+                                           escapeShell(code))
+  f.close()
+  os.chmod(path, 0755)
+  return path
+
+
+def collectScmDiff(scm, cmdline, env, xd_dir, xd=sys.argv[0], job=None,
+                   previous=None):
+  if hasattr(scm, 'collect') and os.environ.get(XD_ENGINE_ENV) != 'extdiff':
+    returncode = scm.collect(cmdline, env, xd_dir, job, previous)
+    if returncode is not None:
+      return returncode
+  cmdline = list(cmdline)
+  env = dict(env)
+  scm.setupExternalDiff(cmdline, env, setupChildCommand(xd_dir, xd))
+  print >>open(os.path.join(xd_dir, 'CMDLINE'), 'w'), cmdline
+  return runScmDiff(cmdline, env, xd_dir, job)
+
+
+class ScmDiffJob(object):
+
+  # Runs collectScmDiff in the background so the GUI can show pairs while
+  # they are being collected.  Every child the engines start is attached to
+  # the job so that kill() can stop it; the SCM of the external diff mode
+  # runs in its own process group, which is stopped together with any
+  # external diff child it started.
+  # previous maps scm.getPairId() to pairs of an earlier run whose files are
+  # still in xd_dir, so an engine can reuse them instead of collecting again.
+
+  def __init__(self, scm, cmdline, env, xd_dir, xd=sys.argv[0], previous=None):
+    import threading
+    import time
+    self.args = (scm, cmdline, env, xd_dir, xd)
+    self.previous = previous
+    self.processes = []
+    self.lock = threading.Lock()
+    self.returncode = None
+    self.cancelled = False
+    self.start_time = time.time()
+    open(os.path.join(xd_dir, 'STDOUT'), 'w').close()
+    self.manifest = Collector(scm, xd_dir)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def run(self):
+    start = traceStart()
+    try:
+      self.returncode = collectScmDiff(*self.args + (self, self.previous))
+      store = BlobStore.open()
+      if store is not None:
+        store.evict()
+      traceSpan('collect', start, returncode=self.returncode)
+    except:
+      if not self.cancelled:
+        import traceback
+        traceback.print_exc()
+      self.returncode = 1
+
+  def poll(self):
+    if self.thread.isAlive():
+      return None
+    return self.returncode
+
+  def wait(self, timeout=None):
+    self.thread.join(timeout)
+    return self.poll()
+
+  def attach(self, process, group=False):
+    self.lock.acquire()
+    try:
+      self.processes.append((process, group))
+    finally:
+      self.lock.release()
+    if self.cancelled:
+      self.terminate()
+
+  def detach(self, process):
+    self.lock.acquire()
+    try:
+      self.processes = [item for item in self.processes
+                        if item[0] is not process]
+    finally:
+      self.lock.release()
+
+  def terminate(self):
+    import signal
+    self.lock.acquire()
+    try:
+      for process, group in self.processes:
+        try:
+          if group:
+            os.killpg(process.pid, signal.SIGTERM)
+          else:
+            os.kill(process.pid, signal.SIGTERM)
+        except OSError:
+          pass
+    finally:
+      self.lock.release()
+
+  def kill(self):
+    self.cancelled = True
+    self.terminate()
+    self.thread.join()
+    self.manifest.close()
+
 
 def mainController(argv=sys.argv):
+  import shutil
+  batch = None
+  if argv[1:2] == ['--batch'] or argv[1:2] and argv[1].startswith('--batch='):
+    batch = argv[1][8:] or 'xd'
+    argv = argv[:1] + argv[2:]
+    os.environ.pop(XD_LAZY_ENV, None)
   scm = ScmMeta.get()
   if scm is None:
     print >>sys.stderr, "fatal: '.' is not managed by scm"
@@ -654,35 +3610,77 @@ def mainController(argv=sys.argv):
   cmdline = scm.setupCmdLine(argv)
   display_cmdline = ' '.join(escapeShell(cmd) for cmd in cmdline)
   print display_cmdline
-  scm.setupExternalDiff(cmdline, env, argv[0])
-  print >>open(os.path.join(xd_dir, 'CMDLINE'), 'w'), cmdline
-  returncode = runScmDiff(cmdline, env, xd_dir)
+  traceInit()
+  start = traceStart()
+  if batch is not None:
+    import multiprocessing
+    pool = multiprocessing.Pool()
+  job = ScmDiffJob(scm, cmdline, env, xd_dir, argv[0])
   try:
-    if returncode != 0:
-      return returncode
-    if not os.path.isfile(os.path.join(xd_dir, 'FILES')):
-      shutil.copyfileobj(open(os.path.join(xd_dir, 'STDOUT')), sys.stdout)
-      return 0
-    return startGui(scm, xd_dir, cmdline, env, display_cmdline)
+    if batch is not None:
+      return runBatch(job, batch, pool, display_cmdline)
+    returncode = job.wait(0.5)
+    if returncode is not None:
+      if returncode != 0:
+        return returncode
+      if not job.manifest.exists():
+        shutil.copyfileobj(open(os.path.join(xd_dir, 'STDOUT')), sys.stdout)
+        return 0
+    return startGui(scm, xd_dir, cmdline, env, display_cmdline, job)
   finally:
+    job.kill()
     shutil.rmtree(xd_dir)
+    traceSpan('controller', start, cmdline=cmdline)
 
 #------------------------------ external diff ------------------------------
 
+def forwardExternalDiff(argv, xd_dir):
+  # The bare _socket module keeps the socket module's imports out of every
+  # child.
+  import _socket
+  s = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+  try:
+    s.connect(os.path.join(xd_dir, 'SOCKET'))
+    s.sendall('\0'.join([os.getcwd()] + list(argv)))
+    s.shutdown(_socket.SHUT_WR)
+    chunks = []
+    while True:
+      data = s.recv(4096)
+      if not data:
+        break
+      chunks.append(data)
+  except _socket.error:
+    return None
+  finally:
+    s.close()
+  reply = ''.join(chunks)
+  if not reply:
+    return None
+  if reply != 'ok':
+    print >>sys.stderr, 'xd: %s' % reply
+    return 1
+  return 0
+
+
 def mainExternalDiff(argv=sys.argv, xd_dir=os.environ.get(XD_DIR_ENV, '.')):
+  start = traceStart()
   xd_dir = os.path.abspath(xd_dir)
+  if os.path.exists(os.path.join(xd_dir, 'SOCKET')):
+    returncode = forwardExternalDiff(argv, xd_dir)
+    if returncode is not None:
+      traceSpan('external diff', start, forwarded=True)
+      return returncode
   print >>open(os.path.join(xd_dir, 'ARGS'), 'a'), argv
-  files_path = os.path.join(xd_dir, 'FILES')
-  if os.path.isfile(files_path):
-    files = cPickle.load(open(files_path))
-  else:
-    files = []
   _, scm_name, _ = os.path.basename(xd_dir).split('.')
   scm = ScmMeta.getByName(scm_name)
   parsed = scm.parseArgs(argv)
-  scm.save(parsed, xd_dir, prefix='p%s' % (len(files) + 1))
-  files.append(parsed)
-  cPickle.dump(files, open(files_path, 'w'))
+  manifest = Manifest(xd_dir)
+  prefix = 'p%s' % manifest.reserveIndex()
+  scm.save(parsed, xd_dir, prefix=prefix)
+  append_start = traceStart()
+  manifest.append(parsed)
+  traceSpan('manifest append', append_start, prefix=prefix)
+  traceSpan('external diff', start, prefix=prefix, path=parsed['path'])
   return 0
 
 #------------------------------ main ------------------------------
@@ -690,6 +3688,9 @@ def mainExternalDiff(argv=sys.argv, xd_dir=os.environ.get(XD_DIR_ENV, '.')):
 def main(argv=sys.argv):
   if isWritableDir(os.environ.get(XD_DIR_ENV)):
     return mainExternalDiff(argv)
+  elif os.environ.get(XD_DIR_ENV):
+    print >>sys.stderr, 'fatal: %s is gone' % os.environ[XD_DIR_ENV]
+    return 1
   else:
     return mainController(argv)
 